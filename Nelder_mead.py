@@ -1,11 +1,17 @@
 import copy
 import math
 import numpy as np
-import time
-import matplotlib.pyplot as plt
+from telemetry import Telemetry, PrintSink, LivePlot, Timed, simplex_record
 
 def nelder_mead(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20, 
-    max_iter=0, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5):
+    max_iter=0, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5, callback=None, plot=False):
+    # callback gets a telemetry record per iteration, by default they are printed
+    # in the background (see telemetry.py) so the loop never blocks, plot=True
+    # also plots them live
+    own_callback = callback is None
+    if own_callback:
+        callback = Telemetry(PrintSink(), *([LivePlot()] if plot else []))
+    f = Timed(f)
     # init
     dim = len(x_start)
     prev_best = f(x_start)
@@ -20,91 +26,203 @@ def nelder_mead(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20,
 
     # simplex iter
     iters = 0
-    plt.ion()
-    fig = plt.figure()
-    ax = fig.add_subplot(1,1,1)
-    ax.set_xlabel('iterations')
-    ax.set_ylabel('function value')
-    while 1:
-        # order
-        response.sort(key=lambda x: x[1])
-        best = response[0][1]
-
-        # break after max_iter
-        if max_iter and iters >= max_iter:
-            print 'maximum number of iterations has been reached'
-            return response[0]
-        iters += 1
-        ax.semilogy(iters,best,'o',color='k')
-        plt.pause(0.001)
-        # plt.show()
-        # break after max_attempts iterations with no improvement
-        time.sleep(0.001)
-        print 'The best value so far is:', best
-
-        if prev_best - best > error:
-            attempts_num = 0
-            prev_best = best
-        else:
-            attempts_num += 1
-        if attempts_num >= max_attempts:
-            print 'number of iterations:',iters
-            print 'current optimal solution within max_attempts is {}'.format(response[0][1])
-            print response[0]
-            return response[0]
-
-        # centroid
-        x0 = [0.0] * dim
-        for tup in response[:-1]:
-            for i, c in enumerate(tup[0]):
-                x0[i] += c / (len(response)-1)
-
-        # reflection
-        xr = x0 + alpha*(x0 - response[-1][0])
-        rscore = f(xr)
-        if response[0][1] <= rscore < response[-2][1]:
-            print 'reflection is running ...'
-            del response[-1]
-            response.append([xr, rscore])
-            continue
-
-        # expansion
-        if rscore < response[0][1]:
-            print 'expansion is running ...'
-            xe = x0 + gamma*(xr - x0)
-            escore = f(xe)
-            if escore < rscore:
-                del response[-1]
-                response.append([xe, escore])
-                continue
+    operation = 'init'
+    try:
+        while 1:
+            # order
+            response.sort(key=lambda x: x[1])
+            best = response[0][1]
+
+            # break after max_iter
+            if max_iter and iters >= max_iter:
+                print 'maximum number of iterations has been reached'
+                return response[0]
+            iters += 1
+            callback(simplex_record(iters, response, operation, f))
+            # break after max_attempts iterations with no improvement
+            if prev_best - best > error:
+                attempts_num = 0
+                prev_best = best
             else:
+                attempts_num += 1
+            if attempts_num >= max_attempts:
+                print 'number of iterations:',iters
+                print 'current optimal solution within max_attempts is {}'.format(response[0][1])
+                print response[0]
+                return response[0]
+
+            # centroid
+            x0 = [0.0] * dim
+            for tup in response[:-1]:
+                for i, c in enumerate(tup[0]):
+                    x0[i] += c / (len(response)-1)
+
+            # reflection
+            xr = x0 + alpha*(x0 - response[-1][0])
+            rscore = f(xr)
+            if response[0][1] <= rscore < response[-2][1]:
+                operation = 'reflection'
                 del response[-1]
                 response.append([xr, rscore])
                 continue
 
-        # contraction
-        if rscore >= response[-2][1]:
-            print 'contraction is running ...'
+            # expansion
+            if rscore < response[0][1]:
+                operation = 'expansion'
+                xe = x0 + gamma*(xr - x0)
+                escore = f(xe)
+                if escore < rscore:
+                    del response[-1]
+                    response.append([xe, escore])
+                    continue
+                else:
+                    del response[-1]
+                    response.append([xr, rscore])
+                    continue
+
+            # contraction
+            if rscore >= response[-2][1]:
+                operation = 'contraction'
+                xc = x0 + rho*(response[-1][0]-x0)
+                cscore = f(xc)
+                if cscore < response[-1][1]:
+                    del response[-1]
+                    response.append([xc, cscore])
+                    continue
+
+            # shrink
+            operation = 'shrink'
+            x1 = response[0][0]
+
+            nresponse = [[x1, f(x1)]]
+            for tup in response[1:]:
+                xi = x1 + sigma*(tup[0] - x1)
+                score = f(xi)
+                nresponse.append([xi, score])
+            response = nresponse
+    finally:
+        if own_callback:
+            callback.close()
+
+def evaluate(f, xs, pool=None):
+    # score independent points, concurrently when a pool (multiprocessing.Pool, ThreadPool, ...) is given
+    if hasattr(f, 'map'):
+        # ObjectiveCache: answer known points locally, send only the misses out
+        return f.map(xs, pool)
+    if pool is None:
+        return [f(x) for x in xs]
+    return list(pool.map(f, xs))
+
+def nelder_mead_parallel(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20,
+    max_iter=0, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5, pool=None, speculative=True, callback=None):
+    """
+    nelder_mead with the independent evaluations handed to pool.map: the initial simplex,
+    the shrink step and, if speculative, reflection/expansion/contraction together.
+    the search path and result are the same as nelder_mead for a deterministic f.
+    @param pool: object with a map method; f must be picklable for a process pool
+    @param speculative: score xr, xe and xc in one batch, costs up to two extra evaluations
+        per iteration but only one round trip
+    @param callback: receives a telemetry record per iteration, printed in the background by default
+    """
+    own_callback = callback is None
+    if own_callback:
+        callback = Telemetry(PrintSink())
+    f = Timed(f)
+    # init
+    dim = len(x_start)
+    simplex = [x_start]
+    for i in range(dim):
+        x = copy.copy(x_start)
+        x[i] = x[i] + step[i]
+        simplex.append(x)
+    scores = evaluate(f, simplex, pool)
+    prev_best = scores[0]
+    attempts_num = 0
+    response = [[x, score] for x, score in zip(simplex, scores)]
+
+    # simplex iter
+    iters = 0
+    operation = 'init'
+    try:
+        while 1:
+            # order
+            response.sort(key=lambda x: x[1])
+            best = response[0][1]
+
+            # break after max_iter
+            if max_iter and iters >= max_iter:
+                print 'maximum number of iterations has been reached'
+                return response[0]
+            iters += 1
+            callback(simplex_record(iters, response, operation, f))
+
+            if prev_best - best > error:
+                attempts_num = 0
+                prev_best = best
+            else:
+                attempts_num += 1
+            if attempts_num >= max_attempts:
+                print 'number of iterations:',iters
+                print 'current optimal solution within max_attempts is {}'.format(response[0][1])
+                print response[0]
+                return response[0]
+
+            # centroid
+            x0 = [0.0] * dim
+            for tup in response[:-1]:
+                for i, c in enumerate(tup[0]):
+                    x0[i] += c / (len(response)-1)
+
+            xr = x0 + alpha*(x0 - response[-1][0])
+            xe = x0 + gamma*(xr - x0)
             xc = x0 + rho*(response[-1][0]-x0)
-            cscore = f(xc)
-            if cscore < response[-1][1]:
+            if speculative:
+                rscore, escore, cscore = evaluate(f, [xr, xe, xc], pool)
+
+            # reflection
+            if not speculative:
+                rscore = f(xr)
+            if response[0][1] <= rscore < response[-2][1]:
+                operation = 'reflection'
                 del response[-1]
-                response.append([xc, cscore])
+                response.append([xr, rscore])
                 continue
 
-        # shrink
-        print 'shrink is running ...'
-        x1 = response[0][0]
+            # expansion
+            if rscore < response[0][1]:
+                operation = 'expansion'
+                if not speculative:
+                    escore = f(xe)
+                if escore < rscore:
+                    del response[-1]
+                    response.append([xe, escore])
+                    continue
+                else:
+                    del response[-1]
+                    response.append([xr, rscore])
+                    continue
+
+            # contraction
+            if rscore >= response[-2][1]:
+                operation = 'contraction'
+                if not speculative:
+                    cscore = f(xc)
+                if cscore < response[-1][1]:
+                    del response[-1]
+                    response.append([xc, cscore])
+                    continue
 
-        nresponse = [[x1, f(x1)]]
-        for tup in response[1:]:
-            xi = x1 + sigma*(tup[0] - x1)
-            score = f(xi)
-            nresponse.append([xi, score])
-        response = nresponse
-    # plt.pause(10)
-    plt.ioff()
-    plt.show()
+            # shrink
+            operation = 'shrink'
+            x1 = response[0][0]
+            xs = [x1 + sigma*(tup[0] - x1) for tup in response[1:]]
+            nresponse = [[x1, response[0][1]]]
+            for xi, score in zip(xs, evaluate(f, xs, pool)):
+                nresponse.append([xi, score])
+            response = nresponse
+    finally:
+        if own_callback:
+            callback.close()
 
 def f_target(xparameter,a=2,b=None):
     x = xparameter[0]
@@ -114,4 +232,4 @@ def f_target(xparameter,a=2,b=None):
 
 if __name__ == "__main__":
     nelder_mead(f_target, np.array([0.0,0.0,0.0]), step=[1.0,1.0,1.0], error=10e-6, max_attempts=20,
-    max_iter=0, alpha=1.0, gamma=2.0, rho= 0.5, sigma=0.5)
\ No newline at end of file
+    max_iter=0, alpha=1.0, gamma=2.0, rho= 0.5, sigma=0.5, plot=True)
\ No newline at end of file
@@ -0,0 +1,231 @@
+import numpy as np
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+import matplotlib
+matplotlib.use('Agg')
+
+# Headless benchmarks of the simulation kernels with fixed seeds and parameters.
+# Every case runs in its own worker process, so the peak memory of one case is
+# not hidden by another. Results are compared against stored baselines:
+#   python benchmarks.py --save     record the baselines
+#   python benchmarks.py            compare and flag regressions (exit code 1)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json')
+
+
+def _pulse(n, seed=0):
+    return 0.1*np.random.RandomState(seed).randn(n)
+
+
+# every case comes with an accuracy check: the largest deviation of its result from a
+# fine-step (or exact) reference, so a change of method shows up as accuracy, not only drift
+
+
+def phi_cost_case(name, N, components):
+    def case():
+        import optimize_3level as o
+        f = getattr(o, name)
+        t = np.arange(N+1)*20.0/N
+        value, gradient = f(_pulse(components*N), t=t, grad=True)
+        return [value, np.linalg.norm(gradient)]
+    return case
+
+
+def phi_cost_accuracy(name, N, components):
+    # exact gradient against a central difference along a random direction
+    def accuracy(result):
+        import optimize_3level as o
+        f = getattr(o, name)
+        t = np.arange(N+1)*20.0/N
+        x = _pulse(components*N)
+        v = np.random.RandomState(1).randn(len(x))
+        v /= np.linalg.norm(v)
+        h = 1e-5
+        directional = (f(x+h*v, t=t)-f(x-h*v, t=t))/(2*h)
+        return abs(np.dot(f(x, t=t, grad=True)[1], v)-directional)
+    return accuracy
+
+
+def cz_phase_case(delay=None):
+    import optimize_3level as o
+    if delay is None:
+        delay = o.swaplen
+    infidelity, leakage = o.cz_phase(leakage=True, delay=delay)
+    return [infidelity, leakage]
+
+
+def cz_phase_accuracy(result):
+    # the same gate on a 10 times finer delay grid
+    import optimize_3level as o
+    fine = np.linspace(o.swaplen[0], o.swaplen[-1], 10*(len(o.swaplen)-1)+1)
+    return np.max(np.abs(np.array(result)-cz_phase_case(fine)))
+
+
+def drag_case(step=0.1):
+    import optimize_3level as o
+    return [o.drag_correct_3level([0.5, 0.0], step=step), o.tranfser_2state(step=step)]
+
+
+def drag_accuracy(result):
+    return np.max(np.abs(np.array(result)-drag_case(step=0.01)))
+
+
+def simisothermy_case(step=0.01):
+    import simEP
+    data = simEP.TwoqubitHeatEngine(step=step).simisothermy(plot=False, output=True, bloch=False, trace=False)
+    return np.real([data[3][-1], data[4][-1]])
+
+
+def simisothermy_accuracy(result):
+    return np.max(np.abs(np.array(result)-simisothermy_case(step=0.005)))
+
+
+def lz_time_case(step=0.1):
+    import simLZ
+    P0, P1 = simLZ.method(step=step).evolution_with_time(output=True, plot=False)
+    return np.real([P0[-1], P1[-1]])
+
+
+def lz_time_accuracy(result):
+    return np.max(np.abs(np.array(result)-lz_time_case(step=0.001)))
+
+
+def lz_theta_case():
+    import simLZ
+    data = simLZ.method().evolution_with_theta(output=True, fitting=False)
+    return np.concatenate([data[2], data[3][0]])
+
+
+def lz_theta_accuracy(result):
+    # coherent reference with exact steps of 0.001, T1 = T2 = 10 us are not included
+    import simLZ
+    data = simLZ.method(step=0.001).evolution_with_theta(output=True, fitting=False, batched=True)
+    return np.max(np.abs(np.array(result)-np.concatenate([data[2], data[3][0]])))
+
+
+def sta_case():
+    from simuSTA import STAmethod
+    P0, P1 = STAmethod(start=0, end=20, step=0.001, thetaf=np.pi/6, T=10).evolution_with_time(plot=False, output=True)
+    return np.real([P0[-1], P1[-1]])
+
+
+def sta_accuracy(result):
+    # magnus4 at tol 1e-12 on the same drive
+    from simuSTA import STAmethod
+    from magnus import magnus4
+    sta = STAmethod(start=0, end=20, thetaf=np.pi/6, T=10)
+    H = lambda t: sta.H_series(np.ravel(t)).reshape(np.shape(t)+(2, 2))
+    psi = magnus4(H, [0.0, 20.0], 0.5*np.array([1+0j, 1]), tol=1e-12)[0][-1]
+    return np.max(np.abs(np.array(result)-np.abs(psi)**2))
+
+
+CASES = [('phi_cost_xy N={}'.format(N), phi_cost_case('phi_cost_xy', N, 2), phi_cost_accuracy('phi_cost_xy', N, 2)) for N in [20, 100, 500]] + \
+        [('phi_cost_xyz N={}'.format(N), phi_cost_case('phi_cost_xyz', N, 3), phi_cost_accuracy('phi_cost_xyz', N, 3)) for N in [20, 100, 500]] + \
+        [('cz_phase', cz_phase_case, cz_phase_accuracy),
+         ('drag_correct_3level', drag_case, drag_accuracy),
+         ('simEP simisothermy', simisothermy_case, simisothermy_accuracy),
+         ('simLZ evolution_with_time', lz_time_case, lz_time_accuracy),
+         ('simLZ evolution_with_theta', lz_theta_case, lz_theta_accuracy),
+         ('STAmethod evolution_with_time', sta_case, sta_accuracy)]
+
+
+def _peak_memory():
+    # ru_maxrss is in kB on linux and in bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else 1024*peak
+
+
+def _current_memory():
+    # resident set size, only available from /proc
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1])*resource.getpagesize()
+    except IOError:
+        return _peak_memory()
+
+
+def _run_case(args):
+    name, repeat = args
+    case, accuracy = dict((case[0], case[1:]) for case in CASES)[name]
+    # first call imports the modules and warms up, it is not timed. the peak working memory
+    # of the case is the peak of the process above what stays resident after it
+    result = case()
+    memory_start = _current_memory()
+    elapsed = []
+    for i in range(repeat):
+        t_start = time.time()
+        result = case()
+        elapsed.append(time.time()-t_start)
+    measured = {'time': min(elapsed), 'memory': max(_peak_memory()-memory_start, 0),
+                'result': [float(r) for r in np.ravel(result)]}
+    # after the timing, the reference runs may need more memory than the case
+    measured['accuracy'] = float(accuracy(result))
+    return measured
+
+
+def run(names=None, repeat=3, baseline=BASELINE, save=False, rtol=1e-8, time_tol=0.2, memory_tol=0.2, accuracy_tol=2.0):
+    """
+    run the cases in names (all by default) and compare them with the baselines.
+    every case reports its accuracy, the deviation from its fine-step reference.
+    a case is flagged when its result moved by more than rtol (relative to the largest
+    baseline value), its time or peak memory grew by more than time_tol/memory_tol,
+    or its accuracy got worse by more than a factor accuracy_tol.
+    @param save: store this run as the new baselines instead
+    returns the measurements and the names of the flagged cases
+    """
+    names = names or [case[0] for case in CASES]
+    stored = {}
+    if os.path.exists(baseline):
+        with open(baseline) as fp:
+            stored = json.load(fp)
+    measured, flagged = {}, []
+    for name in names:
+        pool = multiprocessing.Pool(1)
+        try:
+            m = pool.apply(_run_case, ((name, repeat),))
+        except Exception as e:
+            print('{:32s} FAILED: {}: {}'.format(name, e.__class__.__name__, e))
+            flagged.append(name)
+            continue
+        finally:
+            pool.close()
+            pool.join()
+        measured[name] = m
+        line = '{:32s} {:9.3e} s {:9.2f} MB  accuracy {:.1e}'.format(name, m['time'], m['memory']/2.0**20, m['accuracy'])
+        b = stored.get(name)
+        if b is not None and not save:
+            reference = np.array(b['result'])
+            error = np.max(np.abs(np.array(m['result'])-reference))/max(np.max(np.abs(reference)), 1e-300)
+            slower = m['time'] > (1+time_tol)*b['time']
+            larger = m['memory'] > (1+memory_tol)*b['memory'] and m['memory']-b['memory'] > 2**20
+            worse = m['accuracy'] > accuracy_tol*b.get('accuracy', np.inf)+1e-14
+            line += '  time x{:.2f}, deviation {:.1e}'.format(m['time']/b['time'], error)
+            problems = [text for bad, text in [(error > rtol, 'result'), (slower, 'time'), (larger, 'memory'),
+                                               (worse, 'accuracy')] if bad]
+            if problems:
+                flagged.append(name)
+                line += '  REGRESSION: ' + ', '.join(problems)
+        print(line)
+    if save:
+        stored.update(measured)
+        with open(baseline, 'w') as fp:
+            json.dump(stored, fp, indent=1, sort_keys=True)
+        print('baselines saved to {}'.format(baseline))
+    return measured, flagged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks of the simulation kernels')
+    parser.add_argument('names', nargs='*', help='cases to run, all by default')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--time-tol', type=float, default=0.2, help='allowed relative slowdown')
+    args = parser.parse_args()
+    measured, flagged = run(args.names, repeat=args.repeat, baseline=args.baseline, save=args.save, time_tol=args.time_tol)
+    sys.exit(1 if flagged else 0)
@@ -0,0 +1,39 @@
+from objective_cache import atomic_dump, atomic_load, ObjectiveCache
+
+
+class Checkpoint(object):
+    def __init__(self, filename, resume=True):
+        """
+        optimizer state and measured points kept in one pickle file, rewritten atomically.
+        an optimizer saves its loop state at the top of every iteration; when it is started
+        again with the same file it continues from there, and the points measured since
+        (e.g. half of an interrupted iteration) are replayed from the file instead of measured.
+        @param resume: False ignores an existing file and starts over
+        """
+        self.filename = filename
+        self.state = None
+        self.known = []
+        self.points = None
+        saved = atomic_load(filename) if resume else None
+        if saved is not None:
+            self.state, self.known = saved['state'], saved['known']
+            print('resuming from {}'.format(filename))
+
+    def wrap(self, f, decimals=10):
+        # f recording every new point to the file, known points are not evaluated again
+        self.points = ObjectiveCache(f, maxsize=float('inf'), decimals=decimals, autosave=False)
+        for key, value in self.known:
+            self.points.store[key] = value
+        def objective(x):
+            misses = self.points.misses
+            value = self.points(x)
+            if self.points.misses > misses:
+                self.save()
+            return value
+        return objective
+
+    def save(self, state=None):
+        if state is not None:
+            self.state = state
+        known = list(self.points.store.items()) if self.points is not None else self.known
+        atomic_dump({'state': self.state, 'known': known}, self.filename)
@@ -0,0 +1,35 @@
+import sys
+import types
+
+# Modules imported on first attribute access, so that importing a simulation or
+# fitting helper does not load matplotlib, pyle or labrad until they are used:
+#   plt = lazy_module('matplotlib.pyplot')
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            __import__(self.__name__)
+            self.__dict__['_module'] = sys.modules[self.__name__]
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self.__name__ in sys.modules else 'not loaded'
+        return '<lazy module {} ({})>'.format(self.__name__, state)
+
+
+def lazy_module(name):
+    # the module itself when it is imported already
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
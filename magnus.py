@@ -0,0 +1,168 @@
+import numpy as np
+import time
+from propagator import expm_hermitian, chain, cumulative
+
+# Fourth-order commutator-free Magnus integrator: every step takes two
+# exponentials of H sampled at the Gauss points, so the step can be 10-100x
+# longer than the piecewise-constant steps the simulation scripts use. All
+# samples of H are evaluated and exponentiated as one batch.
+
+GAUSS = np.array([0.5-np.sqrt(3)/6, 0.5+np.sqrt(3)/6])
+CF4 = np.array([0.25+np.sqrt(3)/6, 0.25-np.sqrt(3)/6])
+
+
+def _sample(envelope, t):
+    if callable(envelope):
+        return envelope(t)*np.ones(np.shape(t))
+    return envelope*np.ones(np.shape(t))
+
+
+def envelope_hamiltonian(H0, terms):
+    """
+    H(t) = H0+sum(envelope(t)*operator) for (envelope, operator) in terms,
+    evaluated for an array of times at once. envelopes are Envelope objects
+    (or anything callable on arrays) and must be real-valued.
+    """
+    H0 = np.asarray(H0, dtype=complex)
+    def H(t):
+        t = np.asarray(t, dtype=float)
+        Ht = np.zeros(t.shape+H0.shape, dtype=complex)+H0
+        for envelope, operator in terms:
+            Ht += np.real(_sample(envelope, t))[..., None, None]*operator
+        return Ht
+    return H
+
+
+def drive_components(system, qubits):
+    """
+    drift H0 of a QuantumSystem and, for every qubit of qubits, the operators of a unit
+    Re(uw), Im(uw) and df, so that H(t) = H0+sum(Re(uw)*Hx+Im(uw)*Hy+df*Hdf). they are read
+    off system.H with constant envelopes, the envelopes set on qubits are restored after.
+    returns H0, [(Hx, Hy, Hdf) for every qubit]
+    """
+    from pylesim.envelopes import Envelope
+    def constant(c):
+        return Envelope(lambda t: c+0.0*t, start=None, end=None)
+    saved = [(q.uw, q.df) for q in qubits]
+    try:
+        for q in qubits:
+            q.uw, q.df = constant(0.0), constant(0.0)
+        H0 = np.array(system.H(0.0))
+        operators = []
+        for q in qubits:
+            unit = []
+            for name, value in [('uw', 1.0), ('uw', 1.0j), ('df', 1.0)]:
+                setattr(q, name, constant(value))
+                unit.append(np.array(system.H(0.0))-H0)
+                setattr(q, name, constant(0.0))
+            operators.append(tuple(unit))
+    finally:
+        for q, (uw, df) in zip(qubits, saved):
+            q.uw, q.df = uw, df
+    return H0, operators
+
+
+def system_hamiltonian(system, qubits):
+    """
+    envelope_hamiltonian of a QuantumSystem driven by the uw and df envelopes
+    currently set on qubits, from the operators of drive_components.
+    """
+    H0, operators = drive_components(system, qubits)
+    terms = []
+    for q, (Hx, Hy, Hdf) in zip(qubits, operators):
+        terms += [(lambda t, e=q.uw: np.real(_sample(e, t)), Hx),
+                  (lambda t, e=q.uw: np.imag(_sample(e, t)), Hy), (q.df, Hdf)]
+    return envelope_hamiltonian(H0, terms)
+
+
+def cf4_steps(H, T, substeps=1):
+    """
+    one unitary per interval of the grid T, each made of substeps CF4 steps:
+    U = exp(-1j*h*(a2*H1+a1*H2)) exp(-1j*h*(a1*H1+a2*H2)), H1 and H2 at the Gauss points.
+    returns (len(T)-1, d, d)
+    """
+    T = np.asarray(T, dtype=float)
+    h = np.diff(T)/substeps
+    starts = T[:-1, None]+h[:, None]*np.arange(substeps)
+    H1 = H(starts+GAUSS[0]*h[:, None])
+    H2 = H(starts+GAUSS[1]*h[:, None])
+    first = expm_hermitian(CF4[0]*H1+CF4[1]*H2, h[:, None])
+    second = expm_hermitian(CF4[1]*H1+CF4[0]*H2, h[:, None])
+    # interleave so chain multiplies second*first for every substep
+    steps = np.stack([first, second], axis=-3).reshape(first.shape[:1]+(2*substeps,)+first.shape[-2:])
+    return chain(steps)
+
+
+def magnus4(H, T, psi0=None, tol=1e-8, substeps=1, max_substeps=4096):
+    """
+    fourth-order commutator-free Magnus evolution of H(t) with error control.
+    the intervals of T are split into substeps CF4 steps, doubling the number
+    until two successive results differ by less than 15*tol (the fourth-order
+    Richardson estimate of the error of the finer one is that difference/15).
+    @param H: callable on an array of times, e.g. envelope_hamiltonian or system_hamiltonian
+    @param T: output times, only the results at these times are kept
+    @param psi0: initial state, otherwise the unitaries U(T[k], T[0]) are returned
+    returns the states (len(T), d) or unitaries (len(T), d, d), the estimated error and the substeps used
+    """
+    def evolve(substeps):
+        U = cumulative(cf4_steps(H, T, substeps))
+        U = np.concatenate([np.eye(U.shape[-1], dtype=complex)[None], U])
+        if psi0 is None:
+            return U
+        return np.dot(U, psi0)
+    result = evolve(substeps)
+    error = float('inf')
+    while substeps < max_substeps:
+        substeps *= 2
+        finer = evolve(substeps)
+        error = np.max(np.abs(finer-result))/15.0
+        result = finer
+        if error < tol:
+            break
+    else:
+        print('magnus4: estimated error {:.1e} above tol after {} substeps'.format(error, substeps))
+    return result, error, substeps
+
+
+def benchmark(end=20.0, tols=[1e-4, 1e-6, 1e-8, 1e-10], euler_steps=[0.01, 0.001], output_step=0.5):
+    """
+    accuracy against wall time on the STAmethod counterdiabatic drive: first order Euler
+    steps psi-1j*H*psi*dt (how the hand-rolled evolutions used to step), piecewise-constant
+    (midpoint) propagation as in STAmethod.evolution_with_time, and magnus4 at several
+    tolerances, all compared on the final populations with a tol=1e-12 magnus4 reference.
+    """
+    from simuSTA import STAmethod
+    sta = STAmethod()
+    sigmax = np.array([[0,1],[1,0]], dtype=complex)
+    sigmay = np.array([[0,-1j],[1j,0]], dtype=complex)
+    sigmaz = np.array([[1,0],[0,-1]], dtype=complex)
+    H = envelope_hamiltonian(np.zeros((2,2)), [(sta.STAx(), sigmax), (sta.STAy(), sigmay), (sta.STAz(), sigmaz)])
+    psi0 = 0.5*np.array([1+0j,1])
+    reference = np.abs(magnus4(H, [0.0, end], psi0, tol=1e-12)[0][-1])**2
+    def report(name, P, elapsed):
+        error = np.max(np.abs(P-reference))
+        print('{:34s} {:9.2e} s   max|dP| = {:.1e}'.format(name, elapsed, error))
+        return [elapsed, error]
+    result = {}
+    for step in euler_steps:
+        t_start = time.time()
+        psi = psi0
+        for Ht in H(np.arange(0, end-step/2, step)):
+            psi = psi-1j*np.dot(Ht, psi)*step
+        result['euler', step] = report('Euler, step {}'.format(step), np.abs(psi)**2, time.time()-t_start)
+    for step in euler_steps:
+        t_start = time.time()
+        # one step per grid point, ending at end
+        psi = sta.propagate(np.arange(0, end-step/2, step), psi0)[-1]
+        result['midpoint', step] = report('piecewise constant, step {}'.format(step), np.abs(psi)**2, time.time()-t_start)
+    T0 = np.arange(0, end+output_step/2, output_step)
+    for tol in tols:
+        t_start = time.time()
+        psi, error, substeps = magnus4(H, T0, psi0, tol=tol)
+        name = 'magnus4, tol {:.0e} ({} steps)'.format(tol, substeps*(len(T0)-1))
+        result['magnus4', tol] = report(name, np.abs(psi[-1])**2, time.time()-t_start)
+    return result
+
+
+if __name__ == '__main__':
+    benchmark()
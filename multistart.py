@@ -0,0 +1,137 @@
+import numpy as np
+import multiprocessing
+from optimize_3level import find_optimize
+
+
+class Dominated(Exception):
+    pass
+
+
+def latin_hypercube(n, bounds, seed=None):
+    # one point in each of n equal slices of every axis, bounds is [[low, high], ...] per dimension
+    bounds = np.asarray(bounds, dtype=float)
+    rs = np.random.RandomState(seed)
+    strata = np.array([rs.permutation(n) for i in range(len(bounds))]).T
+    u = (strata+rs.rand(n, len(bounds)))/n
+    return bounds[:,0]+u*(bounds[:,1]-bounds[:,0])
+
+
+# Joe-Kuo direction numbers (s, a, m) of the dimensions after the first
+_SOBOL = [(1, 0, [1]), (2, 1, [1, 3]), (3, 1, [1, 3, 1]), (3, 2, [1, 1, 1]), (4, 1, [1, 1, 3, 3]),
+          (4, 4, [1, 3, 5, 13]), (5, 2, [1, 1, 5, 5, 17]), (5, 4, [1, 1, 5, 5, 5]), (5, 7, [1, 1, 7, 11, 19]),
+          (5, 11, [1, 1, 5, 1, 1]), (5, 13, [1, 1, 1, 3, 11]), (5, 14, [1, 3, 5, 5, 31]),
+          (6, 1, [1, 3, 3, 9, 7, 49]), (6, 13, [1, 1, 1, 15, 21, 21]), (6, 16, [1, 3, 1, 13, 27, 49]),
+          (6, 19, [1, 1, 1, 15, 7, 5]), (6, 22, [1, 3, 1, 15, 13, 25]), (6, 25, [1, 1, 5, 5, 19, 61]),
+          (7, 1, [1, 3, 7, 11, 23, 15, 103]), (7, 4, [1, 3, 7, 13, 13, 15, 69])]
+_BITS = 30
+
+
+def _sobol_directions(d):
+    V = np.zeros((d, _BITS), dtype=np.int64)
+    V[0] = 1 << (_BITS-1-np.arange(_BITS))
+    for j in range(1, d):
+        s, a, m = _SOBOL[j-1]
+        for i in range(_BITS):
+            if i < s:
+                V[j, i] = m[i] << (_BITS-1-i)
+            else:
+                v = V[j, i-s] ^ (V[j, i-s] >> s)
+                for k in range(1, s):
+                    if (a >> (s-1-k)) & 1:
+                        v ^= V[j, i-k]
+                V[j, i] = v
+    return V
+
+
+def sobol(n, bounds, seed=None):
+    # Sobol points in gray code order with a random digital shift, up to 21 dimensions
+    bounds = np.asarray(bounds, dtype=float)
+    d = len(bounds)
+    if d > len(_SOBOL)+1:
+        raise ValueError('sobol points are tabulated for up to {} dimensions'.format(len(_SOBOL)+1))
+    V = _sobol_directions(d)
+    X = np.zeros((n, d), dtype=np.int64)
+    for i in range(1, n):
+        # lowest zero bit of i-1
+        c = 0
+        while (i-1) >> c & 1:
+            c += 1
+        X[i] = X[i-1] ^ V[:, c]
+    X ^= np.random.RandomState(seed).randint(0, 1 << _BITS, size=d)
+    u = X/float(1 << _BITS)
+    return bounds[:,0]+u*(bounds[:,1]-bounds[:,0])
+
+
+class Reporter(object):
+    # find_optimize callback: publishes the best value of a run so far and cancels the run once clearly dominated
+    def __init__(self, store, run, dominance=10.0, min_iter=10):
+        self.store = store
+        self.run = run
+        self.dominance = dominance
+        self.min_iter = min_iter
+        self.iterations = 0
+        self.best = float('inf')
+        self.x = None
+
+    def __call__(self, record):
+        self.iterations += 1
+        if record['value'] < self.best:
+            self.best = float(record['value'])
+            self.x = [float(xi) for xi in record['x']]
+            self.store[self.run] = (self.iterations, self.best, self.x)
+        if self.dominance is None or self.iterations < self.min_iter:
+            return
+        others = [value for run, (iterations, value, x) in self.store.items() if run != self.run]
+        if others and self.best > self.dominance*min(others):
+            raise Dominated()
+
+
+def _run(args):
+    run, f, x0, kw, store, dominance, min_iter = args
+    reporter = Reporter(store, run, dominance, min_iter)
+    try:
+        x, value = find_optimize(f, x=np.array(x0), callback=reporter, **kw)
+        status = 'finished'
+    except Dominated:
+        status = 'dominated'
+    if reporter.x is not None:
+        # the best point seen, a fixed step can leave find_optimize past it
+        x, value = reporter.x, reporter.best
+    return {'run': run, 'start': np.array(x0), 'x': np.array(x), 'value': value, 'status': status}
+
+
+def multistart(f, bounds, n=8, sampler='lhs', seed=None, pool=None, processes=None, store=None,
+               dominance=10.0, min_iter=10, **kw):
+    """
+    run find_optimize from n sampled starting points concurrently and rank the optima.
+    @param bounds: [[low, high], ...] for every component of x
+    @param sampler: 'lhs' (latin hypercube) or 'sobol' (up to 21 parameters)
+    @param pool: multiprocessing pool to use, otherwise one with processes workers is created
+    @param store: shared dict (e.g. multiprocessing.Manager().dict()) receiving
+        run -> (iteration, best value, x) while the runs progress
+    @param dominance: a run is cancelled after min_iter iterations once its best value is more
+        than dominance times the best value of any other run; None never cancels
+    kw are passed on to find_optimize (maxloop, step, fprime, ...); f and fprime must be picklable.
+    the runs do not print their iterations (verbose=False) unless kw asks for it, store has their progress.
+    returns the runs as dicts sorted by value, each with the best point it reached
+    """
+    kw = dict(kw, verbose=kw.get('verbose', False))
+    starts = {'lhs': latin_hypercube, 'sobol': sobol}[sampler](n, bounds, seed)
+    manager = None
+    if store is None:
+        manager = multiprocessing.Manager()
+        store = manager.dict()
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [(run, f, list(x0), kw, store, dominance, min_iter) for run, x0 in enumerate(starts)]
+        results = pool.map(_run, jobs, chunksize=1)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+        if manager is not None:
+            manager.shutdown()
+    results.sort(key=lambda result: result['value'])
+    return results
@@ -0,0 +1,123 @@
+import numpy as np
+import os
+import cPickle as pickle
+from collections import OrderedDict
+
+
+def _replace(src, dst):
+    if os.name == 'nt':
+        # os.rename does not overwrite on windows, MoveFileEx replaces in one step
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING, MOVEFILE_WRITE_THROUGH = 0x1, 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
+def atomic_dump(obj, filename):
+    # pickle to a temporary file first so a crash never leaves a half-written file behind
+    tmp = filename+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(tmp, filename)
+
+
+def atomic_load(filename):
+    """
+    the object atomic_dump saved in filename, None when there is none. a complete
+    temporary file is used when the replace itself was interrupted.
+    """
+    for name in [filename, filename+'.tmp']:
+        if os.path.exists(name):
+            with open(name, 'rb') as fp:
+                return pickle.load(fp)
+    return None
+
+
+class ObjectiveCache(object):
+    def __init__(self, f, maxsize=4096, decimals=10, filename=None, autosave=True):
+        """
+        bounded LRU memo in front of an expensive objective f(x).
+        @param decimals: x is rounded to this many decimals to build the key,
+            so points closer than that share one evaluation
+        @param filename: pickle file the cache is loaded from and saved to between sessions
+        @param autosave: save after every new evaluation when filename is given
+        """
+        self.f = f
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.filename = filename
+        self.autosave = autosave
+        self.hits = 0
+        self.misses = 0
+        self.store = OrderedDict()
+        saved = atomic_load(filename) if filename is not None else None
+        for key, value in saved or []:
+            self.store[key] = value
+
+    def key(self, x):
+        # +0.0 folds -0.0 into 0.0
+        return tuple(np.round(np.asarray(x, dtype=float).ravel(), self.decimals)+0.0)
+
+    def lookup(self, key):
+        value = self.store.pop(key)
+        self.store[key] = value
+        self.hits += 1
+        return value
+
+    def insert(self, key, value):
+        self.misses += 1
+        self.store[key] = value
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    def __call__(self, x):
+        key = self.key(x)
+        if key in self.store:
+            return self.lookup(key)
+        value = self.f(x)
+        self.insert(key, value)
+        if self.autosave and self.filename is not None:
+            self.save()
+        return value
+
+    def map(self, xs, pool=None):
+        # score a batch, only the misses are sent to f (through pool.map when given)
+        keys = [self.key(x) for x in xs]
+        todo = OrderedDict()
+        for key, x in zip(keys, xs):
+            if key not in self.store and key not in todo:
+                todo[key] = x
+        if pool is None:
+            values = [self.f(x) for x in todo.values()]
+        else:
+            values = list(pool.map(self.f, todo.values()))
+        new = dict(zip(todo.keys(), values))
+        result = []
+        for key in keys:
+            if key in self.store:
+                result.append(self.lookup(key))
+            else:
+                self.insert(key, new[key])
+                result.append(new[key])
+        if todo and self.autosave and self.filename is not None:
+            self.save()
+        return result
+
+    def save(self, filename=None):
+        atomic_dump(list(self.store.items()), filename or self.filename)
+
+    def clear(self):
+        self.store.clear()
+        self.hits, self.misses = 0, 0
+
+    def stats(self):
+        calls = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.store),
+                'hit_rate': float(self.hits)/calls if calls else 0.0}
+
+    def report(self):
+        print('cache: {hits} hits, {misses} misses, {size} stored, hit rate {hit_rate:.1%}'.format(**self.stats()))
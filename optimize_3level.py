@@ -3,14 +3,19 @@ import copy
 import math
 import pylesim.quantsim as sim
 from pylesim import envelopes as env
-import matplotlib.pyplot as plt
 import random
 from scipy.linalg import expm
-from pyle.fitting import fitting
 import time
 from pylesim.envelopes import Envelope
-import pylesim.plotting as pyplt
 from scipy.optimize import leastsq
+from propagator import propagate, trace_gradient, blocks, chain, expm_hermitian
+from telemetry import Telemetry, PrintSink, Timed, simplex_record
+from checkpoint import Checkpoint
+from lazy_import import lazy_module
+from magnus import drive_components
+
+plt = lazy_module('matplotlib.pyplot')
+pyplt = lazy_module('pylesim.plotting')
 
 # gloable parameters
 T1, T2 = float('inf'), float('inf')  # coherence time
@@ -59,28 +64,27 @@ class Two_qubit_freq(object):
             return za+zb
         return Envelope(timeFunc, start=t0, end=t0+tf)
 
-    def numerical_pulse(self, x=None, T=None, t0=None, tf=None):
-        def timeFunc(t,T=T):
-            dt = T[1]-T[0]
-            if isinstance(t,int) or isinstance(t,float):
-                if T[0] <= t <= T[-1]:
-                    dt = T[1]-T[0]
-                    i = int(np.floor((t-T[0])/dt))
-                    # print 'i =', i
-                    return x[i]
-                else:
-                    return 0
-            elif isinstance(t,list) or isinstance(t,np.ndarray):
-                xt = []
-                for i in range(len(t)):
-                    if T[0] <= t[i] <= T[-1]:
-                        indexi = int(np.floor((t[i]-T[0])/dt))
-                        xi = x[indexi]
-                        xt.append(xi)
-                    else:
-                        xi = 0
-                        xt.append(xi)
-                return xt
+    def numerical_pulse(self, x=None, T=None, t0=None, tf=None, interp='hold'):
+        # samples x[i] at T[i] kept in a contiguous float buffer, interp is 'hold' (zero-order) or 'linear'.
+        # x may carry trailing axes, x=np.eye(n) returns the (len(t), n) linear map of the pulse
+        samples = np.ascontiguousarray(x, dtype=float)
+        if len(samples) != len(T):
+            raise ValueError('numerical_pulse needs one sample per time, got {} for {}'.format(len(samples), len(T)))
+        T0, Tend, dt = T[0], T[-1], T[1]-T[0]
+        last = len(samples)-1
+        def timeFunc(t):
+            ta = np.asarray(t, dtype=float)
+            u = (ta-T0)/dt
+            i = np.clip(np.floor(u).astype(int), 0, last)
+            if interp == 'linear':
+                # the clamp only matters at t = T[-1], where w = 0
+                w = (u-i).reshape(u.shape+(1,)*(samples.ndim-1))
+                xt = samples[i]*(1-w)+samples[np.minimum(i+1, last)]*w
+            else:
+                xt = samples[i]
+            inside = (ta >= T0)*(ta <= Tend)
+            xt = xt*inside.reshape(inside.shape+(1,)*(samples.ndim-1))
+            return xt if xt.ndim else float(xt)
         return Envelope(timeFunc, start=t0, end=t0+tf)
 
     def czpulse(self, x=np.array([-0.18,-0.0,-0.0,-0.0,-0.0,-0.0,-0.0]), t0=0.0, tgate=(1/coups)/(2*np.sqrt(2))):
@@ -112,19 +116,47 @@ def fit_exp(data, para_guess=[1.0,1.0,1.0,1.0], plot=True):
         plt.show()
     return para_fit
 
-def zpulse_ramsey(delay=np.arange(0,200,1), zamp=-1.0, order=2, tau1_guess=20, tau2_guess=300, amp2_to_all=0.2, fit=True):
-    q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
-    psi0 = np.array([1+0j,1+0j,0])/np.sqrt(2)  # X/2
-    q0.df = Two_qubit_freq().f10A(z=0.0)
-    q0.df += Two_qubit_freq().zpulse_with_filter(t0=delay[0], tf=delay[-1], z=zamp, tau1=DecayTime1, tau2=DecayTime2, amp1=DecayAmp1, amp2=DecayAmp2)
-    system = sim.QuantumSystem([q0])
-    rhos = system.simulate(psi0, delay, method='fast')
-    rhos0 = rhos[:,0:2,0:2]
-    phase = []
-    for i, rho in enumerate(rhos0):
-        nature_phasei = -2*np.pi*zamp*delay[i]
-        phasei = np.angle(rho[0, 1])
-        phase.append(phasei-nature_phasei)
+def zpulse_phase(delay=np.arange(0,200,1), z=-1.0, tau1=DecayTime1, tau2=DecayTime2, amp1=DecayAmp1, amp2=DecayAmp2):
+    # closed-form Ramsey phase of zpulse_with_filter(t0=delay[0], tf=delay[-1]) relative to the natural
+    # phase -2*pi*z*t: the undriven qubit only picks up -2*pi*integral(df). parameters broadcast against
+    # delay, e.g. tau1 of shape (M, 1) gives the (M, len(delay)) traces of M candidate tails at once
+    t = np.asarray(delay, dtype=float)
+    t0 = t[0]
+    tail = amp1*tau1*(np.exp(-t0/tau1)-np.exp(-t/tau1))+amp2*tau2*(np.exp(-t0/tau2)-np.exp(-t/tau2))
+    return -2*np.pi*(z*(t-t0)+tail)+2*np.pi*z*t
+
+def integrated_phase(df, delay, oversample=10):
+    # -2*pi*integral of the envelope df from delay[0], cumulative trapezoid on an oversampled grid
+    t = np.linspace(delay[0], delay[-1], oversample*(len(delay)-1)+1)
+    f = np.real(df(t))
+    phase = -2*np.pi*np.concatenate([[0.0], np.cumsum(0.5*(f[1:]+f[:-1])*np.diff(t))])
+    return np.interp(delay, t, phase)
+
+def zpulse_ramsey(delay=np.arange(0,200,1), zamp=-1.0, order=2, tau1_guess=20, tau2_guess=300, amp2_to_all=0.2, fit=True, method='auto', uw=None):
+    # method: 'analytic' uses zpulse_phase, 'integrate' integrates q0.df numerically, 'simulate' runs the
+    # 3-level density matrix; 'auto' only simulates when a drive uw is present
+    if method == 'auto':
+        method = 'analytic' if uw is None else 'simulate'
+    df = Two_qubit_freq().f10A(z=0.0)
+    df += Two_qubit_freq().zpulse_with_filter(t0=delay[0], tf=delay[-1], z=zamp, tau1=DecayTime1, tau2=DecayTime2, amp1=DecayAmp1, amp2=DecayAmp2)
+    if method == 'analytic':
+        phase = zpulse_phase(delay, z=zamp)
+    elif method == 'integrate':
+        phase = integrated_phase(df, delay)+2*np.pi*zamp*delay
+    else:
+        q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        psi0 = np.array([1+0j,1+0j,0])/np.sqrt(2)  # X/2
+        q0.df = df
+        if uw is not None:
+            q0.uw = uw
+        system = sim.QuantumSystem([q0])
+        rhos = system.simulate(psi0, delay, method='fast')
+        rhos0 = rhos[:,0:2,0:2]
+        phase = []
+        for i, rho in enumerate(rhos0):
+            nature_phasei = -2*np.pi*zamp*delay[i]
+            phasei = np.angle(rho[0, 1])
+            phase.append(phasei-nature_phasei)
     phase = np.unwrap(phase)
     phaseToFit = phase.copy()
     data = [delay,phase]
@@ -134,6 +166,7 @@ def zpulse_ramsey(delay=np.arange(0,200,1), zamp=-1.0, order=2, tau1_guess=20, t
             tau = tau1_guess
             offset = phaseToFit[-1]
             para_guess = [amp, tau, offset]
+            from pyle.fitting import fitting
             v, cov, fitFunc = fitting.fitCurve('exponential', delay, phaseToFit, para_guess)
             phase_Fit = fitFunc(delay, *v)
             decayTime = v[1]
@@ -169,47 +202,103 @@ def sim_1qubit_phi(dt=T[1]-T[0], U_target=np.array([[0,-1j],[-1j,0]])):
     print 'phi =', phi
     return phi 
  
-def cz_phase(x=np.array([-0.18,-0.0,-0.0,-0.0,-0.0,-0.0,-0.0]), S=coups*2, plot=False, delay=swaplen):
+_cz_components = {}
+
+def cz_components(S=coups*2, nonlin=nonlin):
+    # static and unit-detuning parts of the two-transmon Hamiltonian, H(t) = H0+f0(t)*Hq0+f1(t)*Hq1
+    if (S, nonlin) not in _cz_components:
+        q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        q1 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        c12 = sim.Coupler(q0,q1,s=S)
+        system = sim.QuantumSystem([q0,q1],[c12])
+        H0, [(Hx0, Hy0, Hq0), (Hx1, Hy1, Hq1)] = drive_components(system, [q0, q1])
+        _cz_components[S, nonlin] = (H0, Hq0, Hq1)
+    return _cz_components[S, nonlin]
+
+def cz_basis(delay=swaplen, pulse='fourier'):
+    # both pulse shapes are linear in x, column j is the envelope of the j-th component on the delay grid.
+    # pulse: 'fourier' for the 7 czpulse coefficients, 'hold' or 'linear' for numerical_pulse samples on delay
+    if pulse == 'fourier':
+        return np.array([Two_qubit_freq().czpulse(x=xj, t0=delay[0], tgate=delay[-1])(delay) for xj in np.eye(7)]).T
+    return Two_qubit_freq().numerical_pulse(x=np.eye(len(delay)), T=delay, t0=delay[0], tf=delay[-1], interp=pulse)(delay)
+
+def cz_blocks(S=coups*2, comp=np.array([0,1,3,4])):
+    # the excitation-number blocks holding the computational states: |00>, |01>+|10>, |11>+|02>+|20>
+    return [b for b in blocks(*cz_components(S)) if np.in1d(b, comp).any()]
+
+def _cz_infidelity(X, S=coups*2, delay=swaplen, pulse='fourier', leakage=False, detuning=0.0, dS=0.0, dnonlin=0.0):
+    # 1-phi for a stack of candidates X (M, 7), every block propagated together as (M, T, n, n).
+    # detuning of q0 [GHz], coupling and nonlinearity errors broadcast against the rows of X,
+    # the natural phases stay those of the nominal frequencies.
     U_target = np.diag([1,1,1,-1])
     dt = delay[1]-delay[0]
-    q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
-    q1 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
-    c12 = sim.Coupler(q0,q1,s=S)
-    system = sim.QuantumSystem([q0,q1],[c12])
-    psi0 = np.array([0,0,0,0,1+0j,0,0,0,0])
-    q0.df = Two_qubit_freq().f10A(z=5.66)
-    q1.df = Two_qubit_freq().f10B(z=5.24)
-    q0.df += Two_qubit_freq().czpulse(x=x, t0=delay[0], tgate=delay[-1])
-    #q0.df += Two_qubit_freq().zpulse(t0=delay[0], tf=delay[-1], z=-0.18)
-    #q0.df += Two_qubit_freq().numerical_pulse(x=x, T=delay, t0=delay[0], tf=delay[-1])
-    natural_phase1,natural_phase2,natural_phase = [],[],[]
-    sigmaI = np.diag([1,1,1,1,1,1,1,1,1])
-    Ut = sigmaI
-    for loop_t in range(len(delay)):
-        natural_phase1_loop_t = 2*np.pi*q0.df(delay[loop_t])*dt
-        natural_phase2_loop_t = 2*np.pi*q1.df(delay[loop_t])*dt
-        natural_phase_loop_t = 2*np.pi*(q0.df(delay[loop_t])+q1.df(delay[loop_t]))*dt
-        natural_phase1.append(natural_phase1_loop_t)
-        natural_phase2.append(natural_phase2_loop_t)
-        natural_phase.append(natural_phase_loop_t)
-        Ut_loop_t = expm(-1j*system.H(delay[loop_t])*dt)
-        Ut = np.dot(Ut_loop_t, Ut)
-    dynamic_phase = np.angle(np.dot(Ut,psi0)[4])
-    natural_phase1_all,natural_phase2_all = sum(natural_phase1),sum(natural_phase2)
-    natural_phase_all = sum(natural_phase)
-    natural_phase_reduce = divmod(natural_phase_all,2*np.pi)[1]
-    extra_phase = dynamic_phase+natural_phase_reduce
-    #print 'extra_phase =', extra_phase
-    Ut_subm = np.delete(Ut,(2,5,6,7,8),axis=0)
-    Ut_sub = np.delete(Ut_subm,(2,5,6,7,8),axis=1)
-    Ut_sub[1][1] = Ut_sub[1][1]*np.exp(1j*natural_phase2_all)
-    Ut_sub[2][2] = Ut_sub[2][2]*np.exp(1j*natural_phase1_all)
-    Ut_sub[3][3] = Ut_sub[3][3]*np.exp(1j*natural_phase_all)
-    #print 'Ut_sub =', Ut_sub
-    TrU = np.trace(np.dot(U_target.T.conjugate(),Ut_sub))
+    H0, Hq0, Hq1 = cz_components(S)
+    Hs = H0
+    if np.any(dS):
+        Hs = Hs+np.asarray(dS, dtype=float)[...,None,None,None]*(cz_components(S+1.0)[0]-H0)
+    if np.any(dnonlin):
+        Hs = Hs+np.asarray(dnonlin, dtype=float)[...,None,None,None]*(cz_components(S, nonlin+1.0)[0]-H0)
+    f0 = 5.66+np.dot(np.atleast_2d(X), cz_basis(delay, pulse).T)
+    f1 = 5.24*np.ones(f0.shape)
+    f0_error = f0+np.asarray(detuning, dtype=float)[...,None]
+    natural_phase1_all = 2*np.pi*dt*np.cumsum(f0, axis=1)[:,-1]
+    natural_phase2_all = 2*np.pi*dt*np.cumsum(f1, axis=1)[:,-1]
+    natural_phase_all = natural_phase1_all+natural_phase2_all
+    comp = np.array([0,1,3,4])
+    Ut_sub = np.zeros((len(f0),4,4), dtype=complex)
+    for b in cz_blocks(S, comp):
+        Hb = Hs[...,b[:,None],b]+f0_error[...,None,None]*Hq0[b[:,None],b]+f1[...,None,None]*Hq1[b[:,None],b]
+        Ub = chain(expm_hermitian(Hb, dt))
+        inside = np.flatnonzero(np.in1d(b, comp))
+        rows = np.searchsorted(comp, b[inside])
+        Ut_sub[:,rows[:,None],rows] = Ub[:,inside[:,None],inside]
+    # population leaving the computational subspace, averaged over the computational inputs
+    leak = 1-np.mean(np.sum(np.abs(Ut_sub)**2, axis=1), axis=1)
+    Ut_sub[:,1,1] = Ut_sub[:,1,1]*np.exp(1j*natural_phase2_all)
+    Ut_sub[:,2,2] = Ut_sub[:,2,2]*np.exp(1j*natural_phase1_all)
+    Ut_sub[:,3,3] = Ut_sub[:,3,3]*np.exp(1j*natural_phase_all)
+    TrU = np.einsum('ij,mji->m', U_target.T.conjugate(), Ut_sub)
     phi = np.real(1.0/16.0*TrU*TrU.conjugate())
+    if leakage:
+        return 1-phi, leak
+    return 1-phi
+
+def _cz_chunk(args):
+    return _cz_infidelity(*args)
+
+def cz_phase_batch(X, S=coups*2, delay=swaplen, chunk=32, pool=None, pulse='fourier', leakage=False):
+    """
+    infidelity 1-phi of cz_phase for every row of X (M, 7) without a Python loop over candidates.
+    @param chunk: candidates propagated together, bounds memory to chunk*len(delay)*14 complex numbers
+    @param pool: anything with a map method (multiprocessing.Pool, ThreadPool) to spread chunks over cores
+    @param pulse: see cz_basis, rows of X are numerical_pulse samples on delay for 'hold' and 'linear'
+    @param leakage: also return the leakage out of the computational subspace of every row
+    """
+    X = np.atleast_2d(X)
+    chunks = [(X[i:i+chunk], S, delay, pulse, leakage) for i in range(0, len(X), chunk)]
+    if pool is None:
+        result = [_cz_chunk(args) for args in chunks]
+    else:
+        result = pool.map(_cz_chunk, chunks)
+    if leakage:
+        return tuple(np.concatenate(part) for part in zip(*result))
+    return np.concatenate(result)
+
+def cz_phase(x=np.array([-0.18,-0.0,-0.0,-0.0,-0.0,-0.0,-0.0]), S=coups*2, plot=False, delay=swaplen, pulse='fourier', leakage=False):
+    psi0 = np.array([0,0,0,0,1+0j,0,0,0,0])
+    infidelity, leak = _cz_infidelity(x, S=S, delay=delay, pulse=pulse, leakage=True)
+    phi = 1-infidelity[0]
     # print 'phi =', phi
     if plot:
+        q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        q1 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        c12 = sim.Coupler(q0,q1,s=S)
+        system = sim.QuantumSystem([q0,q1],[c12])
+        if pulse == 'fourier':
+            q0.df = Two_qubit_freq().f10A(z=5.66)+Two_qubit_freq().czpulse(x=x, t0=delay[0], tgate=delay[-1])
+        else:
+            q0.df = Two_qubit_freq().f10A(z=5.66)+Two_qubit_freq().numerical_pulse(x=x, T=delay, t0=delay[0], tf=delay[-1], interp=pulse)
+        q1.df = Two_qubit_freq().f10B(z=5.24)
         rhos0 = system.simulate(psi0, delay, method='fast')
         P11 = rhos0[:, 4][:, 4]
         P20 = rhos0[:, 6][:, 6]
@@ -217,13 +306,69 @@ def cz_phase(x=np.array([-0.18,-0.0,-0.0,-0.0,-0.0,-0.0,-0.0]), S=coups*2, plot=
         plt.ylabel('P11')
         plt.plot(delay,P11)
         plt.show()
+    if leakage:
+        return 1-phi, leak[0]
     return 1-phi 
 
 def loss(x):
     return ((x[0]-1.0)**2+(x[1]-2.0)**2+(x[2]-3.0)**2)**2
 
+class Qubit3Drive(object):
+    def __init__(self, w=20.0, t0=10, step=0.1, phase=0):
+        """
+        a single Qubit3 under a cosine microwave drive, built once and reused by every objective call.
+        the drive enters linearly, H(t) = H0+Re(uw)*Hx+Im(uw)*Hy, so a call only samples the new
+        envelope at the step midpoints and propagates to the final time without storing the trajectory.
+        """
+        q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
+        # the unit detuning and nonlinearity change are for robustness sweeps
+        self.H0, [(self.Hx, self.Hy, self.Hdf)] = drive_components(sim.QuantumSystem([q0]), [q0])
+        q1 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin+1.0)
+        self.Hnonlin = drive_components(sim.QuantumSystem([q1]), [q1])[0]-self.H0
+        self.psi0 = np.array([1+0j,0,0])
+        self.T0 = np.arange(0,w+step,step)
+        self.dt = step
+        self.phase = phase
+        self.x = self.T0[:-1]+step/2.0-t0
+        window = ((self.x+w/2.)>0) * ((-self.x+w/2.)>0)
+        # unit cosine envelope and its time derivative
+        self.shape = 0.5*(1+np.cos(2*np.pi*self.x/w))*window
+        self.slope = -np.pi/w*np.sin(2*np.pi*self.x/w)*window
+
+    def carrier(self, df):
+        return np.exp(1j*self.phase-2j*np.pi*df*self.x)
+
+    def populations(self, uw, detuning=0.0, scale=1.0, dnonlin=0.0):
+        # final populations for the drive samples uw. detuning [GHz], drive scale and
+        # nonlinearity error broadcast over leading axes, e.g. a grid of errors (G,) gives (G, 3)
+        detuning, scale, dnonlin = [np.asarray(e, dtype=float)[...,None,None,None] for e in (detuning, scale, dnonlin)]
+        Ht = self.H0+detuning*self.Hdf+dnonlin*self.Hnonlin+scale*(uw.real[:,None,None]*self.Hx+uw.imag[:,None,None]*self.Hy)
+        psi = np.dot(propagate(Ht, self.dt), self.psi0)
+        return np.abs(psi)**2
+
+    def drag(self, alpha, deltaf, amp, **errors):
+        # cosine-1j*alpha/(2*pi*nonlin)*deriv(cosine), as in drag_correct_3level
+        cosine = amp*self.shape*self.carrier(deltaf)
+        deriv = amp*(self.slope-2j*np.pi*deltaf*self.shape)*self.carrier(deltaf)
+        return self.populations(cosine-1j*(alpha/(2*np.pi*nonlin))*deriv, **errors)
+
+    def transfer(self, amp1, amp2, deltaf=0):
+        # two cosine tones at deltaf and nonlin, as in tranfser_2state
+        return self.populations(self.shape*(amp1*self.carrier(deltaf)+amp2*self.carrier(nonlin)))
+
+_qubit3_drives = {}
+
+def qubit3_drive(w=20.0, t0=10, step=0.1, phase=0):
+    key = (w, t0, step, phase)
+    if key not in _qubit3_drives:
+        _qubit3_drives[key] = Qubit3Drive(w=w, t0=t0, step=step, phase=phase)
+    return _qubit3_drives[key]
+
 def drag_correct_3level(variable=[0.5,0.0], t0=10, w=20.0, step=0.1, phase=0, bloch=False):
     alpha, deltaf = variable[0], variable[1]
+    if not bloch:
+        P0, P1, P2 = qubit3_drive(w=w, t0=t0, step=step, phase=phase).drag(alpha, deltaf, amp=1.0/w)
+        return 1 - P1
     q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
     system = sim.QuantumSystem([q0])
     psi0 = np.array([1+0j,0,0])
@@ -247,6 +392,9 @@ def drag_correct_3level(variable=[0.5,0.0], t0=10, w=20.0, step=0.1, phase=0, bl
 def tranfser_2state(variable=[1/100.0*np.sqrt(2),1/100.0], step=0.1, w=100, phase=0, deltaf=0, plot=False):
     t0 = w/2.0
     amp1, amp2 = variable[0], variable[1]
+    if not plot:
+        P0, P1, P2 = qubit3_drive(w=w, t0=t0, step=step, phase=phase).transfer(amp1, amp2, deltaf=deltaf)
+        return 1 - P2
     q0 = sim.Qubit3(T1=T1, T2=T2, nonlin=nonlin)
     system = sim.QuantumSystem([q0])
     psi0 = np.array([1+0j,0,0])
@@ -268,104 +416,124 @@ def tranfser_2state(variable=[1/100.0*np.sqrt(2),1/100.0], step=0.1, w=100, phas
         plt.show()
     return 1 - np.real(P2[-1])
 
-def phi_2level(x=None, t=T, U_target=np.array([[0,-1j],[-1j,0]]), t0=0, N=20, lamda=np.sqrt(2), delta=nonlin*2*np.pi, plot=False):
+def _control_matrix(t, n, t0, dt):
+    # column i is the window [t0+i*dt-dt/2, t0+i*dt+dt/2) of the i-th control amplitude
+    centers = t0+dt*np.arange(n)
+    t = np.asarray(t)[:, None]
+    return ((centers-dt/2.0 <= t)*(t < centers+dt/2.0)).astype(float)
+
+def phi_2level(x=None, t=T, U_target=np.array([[0,-1j],[-1j,0]]), t0=0, N=20, lamda=np.sqrt(2), delta=nonlin*2*np.pi, plot=False, grad=False):
     dt = t[1]-t[0]
-    sigmaI = np.diag([1,1])
+    x = np.asarray(x)
     Hx = 0.5*np.array([[0,1],[1,0]])
     Hy = 0.5*np.array([[0,-1j],[1j,0]])
-    Ht = []
-    xt,yt = np.zeros(len(t)),np.zeros(len(t))
-    scope1 = range(len(x))
-    for i in scope1:
-        xti = x[i]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        t0 += dt
-        xt = xt+xti
-    Ut = sigmaI
-    for loop_t in range(len(t)):
-        Ht_loop_t = xt[loop_t]*Hx+yt[loop_t]*Hy
-        Ut_loop_t = expm(-1j*Ht_loop_t*dt)
-        Ut = np.dot(Ut_loop_t, Ut)
-        Ht.append(Ht_loop_t)
-    TrU = np.trace(np.dot(U_target.T.conjugate(),Ut))
+    M = _control_matrix(t, len(x), t0, dt)
+    xt = np.dot(M, x)
+    yt = np.zeros(len(t))
+    Ht = xt[:,None,None]*Hx+yt[:,None,None]*Hy
+    if grad:
+        TrU, dTrU = trace_gradient(Ht, [Hx], dt, U_target.T.conjugate())
+        dphi = 0.5*np.real(TrU.conjugate()*dTrU)
+    else:
+        Ut = propagate(Ht, dt)
+        TrU = np.trace(np.dot(U_target.T.conjugate(),Ut))
     phi = np.real(0.25*TrU*TrU.conjugate())
     # print 'phi =', phi
     if plot:
         plt.plot(t,xt)
         plt.show()
+    if grad:
+        return phi, np.dot(dphi[0], M)
     return phi 
 
-def phi_cost_xy(x=None, t=T, U_target=np.array([[0,-1j,0],[-1j,0,0],[0,0,0]]), t0=0, N=20, lamda=np.sqrt(2), delta=nonlin*2*np.pi, plot=False):
+def phi_cost_xy(x=None, t=T, U_target=np.array([[0,-1j,0],[-1j,0,0],[0,0,0]]), t0=0, N=20, lamda=np.sqrt(2), delta=nonlin*2*np.pi, plot=False, grad=False):
     dt = t[1]-t[0]
-    sigmaI = np.diag([1,1,1])
+    x = np.asarray(x)
     projection = np.diag([1,1,0])
     Hd = np.diag([0,0,delta])
     Hx = 0.5*np.array([[0,1,0],[1,0,lamda],[0,lamda,0]])
     Hy = 0.5*np.array([[0,-1j,0],[1j,0,-1j*lamda],[0,1j*lamda,0]])
     Hz = np.diag([0,1,2])
-    Ht = []
-    xt,yt,zt = np.zeros(len(t)),np.zeros(len(t)),np.zeros(len(t))
-    scope1, scope2 = range(len(x)/2), range(len(x)/2,len(x))
-    for i,j in zip(scope1,scope2):
-        xti = x[i]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        ytj = x[j]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        t0 += dt
-        xt, yt = xt+xti, yt+ytj
-    Ut = sigmaI
-    for loop_t in range(len(t)):
-        Ht_loop_t = Hd+xt[loop_t]*Hx+yt[loop_t]*Hy+zt[loop_t]*Hz
-        Ut_loop_t = expm(-1j*Ht_loop_t*dt)
-        Ut = np.dot(Ut_loop_t, Ut)
-        Ht.append(Ht_loop_t)
-    Ut_sub = np.dot(projection,Ut)
+    n = len(x)//2
+    M = _control_matrix(t, n, t0, dt)
+    xt, yt, zt = np.dot(M, x[:n]), np.dot(M, x[n:2*n]), np.zeros(len(t))
+    Ht = Hd+xt[:,None,None]*Hx+yt[:,None,None]*Hy+zt[:,None,None]*Hz
     U_target_new_sub = np.dot(projection,U_target.T.conjugate())
-    TrU = np.trace(np.dot(U_target_new_sub,Ut_sub))
+    if grad:
+        TrU, dTrU = trace_gradient(Ht, [Hx,Hy,Hz], dt, np.dot(U_target_new_sub,projection))
+        dphi = 0.5*np.real(TrU.conjugate()*dTrU)
+    else:
+        Ut = propagate(Ht, dt)
+        Ut_sub = np.dot(projection,Ut)
+        TrU = np.trace(np.dot(U_target_new_sub,Ut_sub))
     phi = np.real(0.25*TrU*TrU.conjugate())
     # print 'phi =', phi
     if plot:
         plt.plot(t,xt,t,yt)
         plt.show()
+    if grad:
+        gradients = np.zeros(len(x))
+        gradients[:n], gradients[n:2*n] = -np.dot(dphi[0], M), -np.dot(dphi[1], M)
+        return 1-phi, gradients
     return 1-phi
 
-def phi_cost_xyz(x=None, t=T, U_target=np.array([[0,-1j,0],[-1j,0,0],[0,0,0]]), t0=0, N=20, lamda=np.sqrt(2),delta=nonlin*2*np.pi, plot=False):
+def phi_cost_xyz(x=None, t=T, U_target=np.array([[0,-1j,0],[-1j,0,0],[0,0,0]]), t0=0, N=20, lamda=np.sqrt(2),delta=nonlin*2*np.pi, plot=False, grad=False):
     dt = t[1]-t[0]
-    sigmaI = np.diag([1,1,1])
+    x = np.asarray(x)
     projection = np.diag([1,1,0])
     Hd = np.diag([0,0,delta])
     Hx = 0.5*np.array([[0,1,0],[1,0,lamda],[0,lamda,0]])
     Hy = 0.5*np.array([[0,-1j,0],[1j,0,-1j*lamda],[0,1j*lamda,0]])
     Hz = np.diag([0,1,2])
-    Ht = []
-    xt,yt,zt = np.zeros(len(t)),np.zeros(len(t)),np.zeros(len(t))
-    scope1, scope2, scope3 = range(len(x)/3), range(len(x)/3,2*len(x)/3), range(2*len(x)/3,len(x))
-    for i,j,k in zip(scope1,scope2,scope3):
-        xti = x[i]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        ytj = x[j]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        ztk = x[k]*(t0-dt/2.0<=t)*(t<t0+dt/2.0)
-        t0 += dt
-        xt, yt, zt = xt+xti, yt+ytj, zt+ztk
-    Ut = sigmaI
-    for loop_t in range(len(t)):
-        Ht_loop_t = Hd+xt[loop_t]*Hx+yt[loop_t]*Hy+zt[loop_t]*Hz
-        Ut_loop_t = expm(-1j*Ht_loop_t*dt)
-        Ut = np.dot(Ut_loop_t, Ut)
-        Ht.append(Ht_loop_t)
-    Ut_sub = np.dot(projection,Ut)
+    n1, n2 = len(x)//3, 2*len(x)//3
+    n = min(n1, n2-n1, len(x)-n2)
+    M = _control_matrix(t, n, t0, dt)
+    xt, yt, zt = np.dot(M, x[:n]), np.dot(M, x[n1:n1+n]), np.dot(M, x[n2:n2+n])
+    Ht = Hd+xt[:,None,None]*Hx+yt[:,None,None]*Hy+zt[:,None,None]*Hz
     U_target_new_sub = np.dot(projection,U_target.T.conjugate())
-    TrU = np.trace(np.dot(U_target_new_sub,Ut_sub))
+    if grad:
+        TrU, dTrU = trace_gradient(Ht, [Hx,Hy,Hz], dt, np.dot(U_target_new_sub,projection))
+        dphi = 0.5*np.real(TrU.conjugate()*dTrU)
+    else:
+        Ut = propagate(Ht, dt)
+        Ut_sub = np.dot(projection,Ut)
+        TrU = np.trace(np.dot(U_target_new_sub,Ut_sub))
     phi = np.real(0.25*TrU*TrU.conjugate())
     if plot:
         plt.plot(t,xt,t,yt,t,zt)
         plt.show()
+    if grad:
+        gradients = np.zeros(len(x))
+        gradients[:n], gradients[n1:n1+n], gradients[n2:n2+n] = \
+            -np.dot(dphi[0], M), -np.dot(dphi[1], M), -np.dot(dphi[2], M)
+        return 1-phi, gradients
     return 1-phi
 
-def gradient_descense(f, x, step=0.01, num=10, adapt_step=False):
+class ExactGradient(object):
+    # fprime for the cost functions above that accept grad=True
+    def __init__(self, f, **kw):
+        self.f = f
+        self.kw = kw
+
+    def __call__(self, x):
+        return self.f(x, grad=True, **self.kw)[1]
+
+    def value_and_gradient(self, x):
+        # f(x) and its gradient from the same forward pass
+        return self.f(x, grad=True, **self.kw)
+
+def gradient_descense(f, x, step=0.01, num=10, adapt_step=False, fprime=None):
     alpha = 1e-5
-    gradients = np.zeros(x.shape)
+    if fprime is None:
+        gradients = np.zeros(x.shape)
+    else:
+        gradients = np.asarray(fprime(x), dtype=float)
     gradient_new = []
     for loop_i in range(len(gradients)): 
         delta_vector = np.zeros(x.shape)
         delta_vector[loop_i] = alpha
-        gradients[loop_i] = (f(x+delta_vector)-f(x-delta_vector)) / (2*alpha)
+        if fprime is None:
+            gradients[loop_i] = (f(x+delta_vector)-f(x-delta_vector)) / (2*alpha)
         if adapt_step:
             power_loop_i = []
             n = 1e3*np.random.rand(num)
@@ -373,9 +541,19 @@ def gradient_descense(f, x, step=0.01, num=10, adapt_step=False):
                 xtest = 0.0001*np.ones(x.shape)
                 xtest[loop_i] = random.sample(n, 1)[0]
                 try:
-                    if float(f(xtest)) != 0:
-                        gradient_loop_j = (f(xtest+delta_vector)-f(xtest-delta_vector))/(2*alpha)
-                        power_loop_j = (xtest[loop_i]*gradient_loop_j)/float(f(xtest))
+                    # f(xtest) once per probe, with the gradient when fprime gives both in one pass
+                    gradient_loop_j = None
+                    if hasattr(fprime, 'value_and_gradient'):
+                        value, gradient = fprime.value_and_gradient(xtest)
+                        value, gradient_loop_j = float(value), gradient[loop_i]
+                    else:
+                        value = float(f(xtest))
+                    if value != 0:
+                        if gradient_loop_j is None and fprime is None:
+                            gradient_loop_j = (f(xtest+delta_vector)-f(xtest-delta_vector))/(2*alpha)
+                        elif gradient_loop_j is None:
+                            gradient_loop_j = fprime(xtest)[loop_i]
+                        power_loop_j = (xtest[loop_i]*gradient_loop_j)/value
                         power_loop_i.append(power_loop_j)
                 except ValueError:
                     pass
@@ -388,36 +566,64 @@ def gradient_descense(f, x, step=0.01, num=10, adapt_step=False):
     else:
         return x - gradients * step
 
-def find_optimize(f, x=np.array([0.0,0.0]), maxloop=100, epsilon=1e-6, step=0.01, adapt_step=True, adjust_size=False, factor_up=2.0, factor_down=0.5, counts=0):
-    for i in range(maxloop):
+def find_optimize(f, x=np.array([0.0,0.0]), maxloop=100, epsilon=1e-6, step=0.01, adapt_step=None, adjust_size=False, factor_up=2.0, factor_down=0.5, counts=0, fprime=None, callback=None,
+                  checkpoint=None, resume=True, verbose=True):
+    # fprime: exact gradient of f, e.g. ExactGradient(phi_cost_xyz), instead of finite differences
+    # adapt_step: rescale the gradient from random probes of f, on by default only without fprime,
+    #     the probes cost num evaluations per component and would outweigh the exact gradient
+    # callback: receives a record with counts, value, x and step after every iteration
+    # checkpoint: file keeping x, its value and the step after every iteration, run again with it to resume
+    # verbose: print every iteration, turn off when the callback reports instead
+    if adapt_step is None:
+        adapt_step = fprime is None
+    cp = Checkpoint(checkpoint, resume=resume) if checkpoint else None
+    start = 0
+    if cp is not None and cp.state is not None:
+        x, newvalue, step, counts, start = [cp.state[key] for key in ['x', 'value', 'step', 'counts', 'loop']]
+        if newvalue <= epsilon:
+            return x, newvalue
+    for i in range(start, maxloop):
         counts += 1
-        print '--------------------------------------'
-        print 'counts =', counts
-        print 'step =', step
-        oldvalue = f(x)
-        print 'oldvalue =', oldvalue
-        x = gradient_descense(f, x, step=step, adapt_step=adapt_step)
+        oldvalue = f(x) if i == 0 else newvalue
+        x = gradient_descense(f, x, step=step, adapt_step=adapt_step, fprime=fprime)
         newvalue = f(x)
-        print 'newvalue =', newvalue
+        if verbose:
+            print '--------------------------------------'
+            print 'counts =', counts
+            print 'step =', step
+            print 'oldvalue =', oldvalue
+            print 'newvalue =', newvalue
         time.sleep(0.001) 
         if adjust_size:
             # step size is too large and needs to be reduced
             if newvalue - oldvalue > 0.0:
-                print 'step size is large'
+                change = 'large'
                 step = step*factor_down
             # step size is too small, need to increase
             elif newvalue - oldvalue < 0.0 and np.abs(1-float(newvalue)/float(oldvalue)) < 0.1:
-                print 'step size is small'
+                change = 'small'
                 step = step*factor_up
             else:
-                print 'step size is normal'
-        print ('x = {}'.format(x))
-        print 'phi = {}, loss = {}'.format(1-newvalue,newvalue)
+                change = 'normal'
+            if verbose:
+                print 'step size is {}'.format(change)
+        if verbose:
+            print ('x = {}'.format(x))
+            print 'phi = {}, loss = {}'.format(1-newvalue,newvalue)
+        if callback is not None:
+            callback({'counts': counts, 'value': newvalue, 'x': x, 'step': step})
+        if cp is not None:
+            cp.save({'x': x, 'value': newvalue, 'step': step, 'counts': counts, 'loop': i+1})
         if newvalue <= epsilon :
             break
     return x, newvalue
 
-def nelder_mead(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20, max_iter=0, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5):
+def nelder_mead(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20, max_iter=0, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5, callback=None):
+    # callback gets a telemetry record per iteration, printed in the background by default
+    own_callback = callback is None
+    if own_callback:
+        callback = Telemetry(PrintSink(fmt='counts = {iteration}\nThe best value so far is: {best} at {x}'))
+    f = Timed(f)
     # initial
     dim = len(x_start)
     prev_best = f(x_start)
@@ -430,75 +636,76 @@ def nelder_mead(f, x_start, step=[0.1,0.1,0.1], error=10e-6, max_attempts=20, ma
         response.append([x, score])
     # simplex iter
     iters = 0
-    while 1:
-        # order
-        response.sort(key=lambda x: x[1])
-        best = response[0][1]
-        # break after max_iter
-        if max_iter and iters >= max_iter:
-            print 'maximum number of iterations has been reached'
-            return response[0]
-        iters += 1
-        print 'counts =', iters
-        # break after max_attempts iterations with no improvement
-        time.sleep(0.001)
-        print response[0]
-        print 'The best value so far is:', best
-
-        if prev_best - best > error:
-            attempts_num = 0
-            prev_best = best
-        else:
-            attempts_num += 1
-        if attempts_num >= max_attempts:
-            print 'number of iterations:',iters
-            print 'current optimal solution within max_attempts is {}'.format(response[0][1])
-            print response[0]
-            return response[0]
-        # centroid
-        x0 = [0.0] * dim
-        for tup in response[:-1]:
-            for i, c in enumerate(tup[0]):
-                x0[i] += c / (len(response)-1)
-        # reflection
-        xr = x0 + alpha*(x0 - response[-1][0])
-        rscore = f(xr)
-        if response[0][1] <= rscore < response[-2][1]:
-            print 'reflection is running ...'
-            del response[-1]
-            response.append([xr, rscore])
-            continue
-        # expansion
-        if rscore < response[0][1]:
-            print 'expansion is running ...'
-            xe = x0 + gamma*(xr - x0)
-            escore = f(xe)
-            if escore < rscore:
-                del response[-1]
-                response.append([xe, escore])
-                continue
+    operation = 'init'
+    try:
+        while 1:
+            # order
+            response.sort(key=lambda x: x[1])
+            best = response[0][1]
+            # break after max_iter
+            if max_iter and iters >= max_iter:
+                print 'maximum number of iterations has been reached'
+                return response[0]
+            iters += 1
+            callback(simplex_record(iters, response, operation, f))
+            # break after max_attempts iterations with no improvement
+            if prev_best - best > error:
+                attempts_num = 0
+                prev_best = best
             else:
+                attempts_num += 1
+            if attempts_num >= max_attempts:
+                print 'number of iterations:',iters
+                print 'current optimal solution within max_attempts is {}'.format(response[0][1])
+                print response[0]
+                return response[0]
+            # centroid
+            x0 = [0.0] * dim
+            for tup in response[:-1]:
+                for i, c in enumerate(tup[0]):
+                    x0[i] += c / (len(response)-1)
+            # reflection
+            xr = x0 + alpha*(x0 - response[-1][0])
+            rscore = f(xr)
+            if response[0][1] <= rscore < response[-2][1]:
+                operation = 'reflection'
                 del response[-1]
                 response.append([xr, rscore])
                 continue
-        # contraction
-        if rscore >= response[-2][1]:
-            print 'contraction is running ...'
-            xc = x0 + rho*(response[-1][0]-x0)
-            cscore = f(xc)
-            if cscore < response[-1][1]:
-                del response[-1]
-                response.append([xc, cscore])
-                continue
-        # shrink
-        print 'shrink is running ...'
-        x1 = response[0][0]
-        nresponse = [[x1, f(x1)]]
-        for tup in response[1:]:
-            xi = x1 + sigma*(tup[0] - x1)
-            score = f(xi)
-            nresponse.append([xi, score])
-        response = nresponse
+            # expansion
+            if rscore < response[0][1]:
+                operation = 'expansion'
+                xe = x0 + gamma*(xr - x0)
+                escore = f(xe)
+                if escore < rscore:
+                    del response[-1]
+                    response.append([xe, escore])
+                    continue
+                else:
+                    del response[-1]
+                    response.append([xr, rscore])
+                    continue
+            # contraction
+            if rscore >= response[-2][1]:
+                operation = 'contraction'
+                xc = x0 + rho*(response[-1][0]-x0)
+                cscore = f(xc)
+                if cscore < response[-1][1]:
+                    del response[-1]
+                    response.append([xc, cscore])
+                    continue
+            # shrink
+            operation = 'shrink'
+            x1 = response[0][0]
+            nresponse = [[x1, f(x1)]]
+            for tup in response[1:]:
+                xi = x1 + sigma*(tup[0] - x1)
+                score = f(xi)
+                nresponse.append([xi, score])
+            response = nresponse
+    finally:
+        if own_callback:
+            callback.close()
 
 
 if __name__ == '__main__':
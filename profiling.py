@@ -0,0 +1,243 @@
+import numpy as np
+import time
+import json
+import functools
+from collections import defaultdict
+
+# Opt-in timing of named regions. Nothing is patched until install() (or the
+# profile() context) is used, so an uninstrumented run pays nothing; region()
+# blocks written into the code cost one flag test while profiling is off.
+#
+#   with profiling.profile(swapcz, filename='profile.json'):
+#       swapcz.nelder_mead_cz(s)
+#
+# install() wraps the shared entry points the experiments and simulations go
+# through: gc.Algorithm construction up to alg.compile ('sequence') and the
+# compile itself ('compile'), runQubits request to result ('runQubits'),
+# readout.iqToProbs, fits (leastsq, curve_fit, rb.fitData), dataset.add,
+# plotting (plt.show/savefig/pause, plotTrajectory) and pylesim simulate.
+# Every sweeps.grid call is one sweep: its statistics are printed when it ends.
+
+enabled = False
+_stack = [defaultdict(list)]
+_patches = []
+
+
+def record(name, seconds):
+    _stack[-1][name].append(seconds)
+
+
+class _Region(object):
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.time()-self.start)
+
+
+class _NoRegion(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_no_region = _NoRegion()
+
+
+def region(name):
+    # with region('fitting'): ...
+    if not enabled:
+        return _no_region
+    return _Region(name)
+
+
+def timed(name):
+    # decorator version of region
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            if not enabled:
+                return func(*args, **kw)
+            start = time.time()
+            try:
+                return func(*args, **kw)
+            finally:
+                record(name, time.time()-start)
+        return wrapper
+    return decorator
+
+
+def summary(stats=None):
+    # count, total and percentiles [s] of every region
+    stats = _stack[-1] if stats is None else stats
+    result = {}
+    for name, times in stats.items():
+        times = np.array(times)
+        p50, p90, p99 = np.percentile(times, [50, 90, 99])
+        result[name] = {'count': len(times), 'total': float(np.sum(times)), 'mean': float(np.mean(times)),
+                        'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(np.max(times))}
+    return result
+
+
+def report(stats=None, title='profile', filename=None):
+    result = summary(stats)
+    print('{}: {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(title, 'count', 'total', 'p50', 'p90', 'p99', 'max'))
+    for name in sorted(result, key=lambda name: -result[name]['total']):
+        r = result[name]
+        print('  {:20s} {count:8d} {total:10.3f} {p50:10.2e} {p90:10.2e} {p99:10.2e} {max:10.2e}'.format(name, **r))
+    if filename is not None:
+        with open(filename, 'w') as fp:
+            json.dump(result, fp, indent=1, sort_keys=True)
+    return result
+
+
+def reset():
+    _stack[:] = [defaultdict(list)]
+
+
+def _patch(obj, attr, replacement):
+    _patches.append((obj, attr, getattr(obj, attr)))
+    setattr(obj, attr, replacement)
+
+
+def _wrap(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        start = time.time()
+        try:
+            return func(*args, **kw)
+        finally:
+            record(name, time.time()-start)
+    return wrapper
+
+
+def _wrap_request(func, name):
+    # time until the returned deferred fires, or the call itself for plain results
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        start = time.time()
+        result = func(*args, **kw)
+        if hasattr(result, 'addCallback'):
+            def done(value):
+                record(name, time.time()-start)
+                return value
+            result.addCallback(done)
+        else:
+            record(name, time.time()-start)
+        return result
+    return wrapper
+
+
+def _wrap_sweep(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        _stack.append(defaultdict(list))
+        start = time.time()
+        try:
+            return func(*args, **kw)
+        finally:
+            stats = _stack.pop()
+            stats['sweep'].append(time.time()-start)
+            report(stats, title='sweep')
+            for name, times in stats.items():
+                _stack[-1][name].extend(times)
+    return wrapper
+
+
+def _wrap_datasets(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        dataset = func(*args, **kw)
+        if hasattr(dataset, 'add'):
+            dataset.add = _wrap(dataset.add, 'dataset.add')
+        return dataset
+    return wrapper
+
+
+def _timed_algorithm(Algorithm):
+    class TimedAlgorithm(Algorithm):
+        def __init__(self, *args, **kw):
+            Algorithm.__init__(self, *args, **kw)
+            self._created = time.time()
+
+        def compile(self, *args, **kw):
+            record('sequence', time.time()-self._created)
+            start = time.time()
+            try:
+                return Algorithm.compile(self, *args, **kw)
+            finally:
+                record('compile', time.time()-start)
+    TimedAlgorithm.__name__ = Algorithm.__name__
+    return TimedAlgorithm
+
+
+def install(*modules):
+    """
+    wrap the shared entry points and, in every module of modules, the names it imported
+    directly (runQubits, leastsq, curve_fit, plotTrajectory). uninstall() restores them.
+    """
+    global enabled
+    if _patches:
+        uninstall()
+    targets = [('pyle.gateCompiler', 'Algorithm', _timed_algorithm),
+               ('pyle.analysis.readout', 'iqToProbs', lambda f: _wrap(f, 'iqToProbs')),
+               ('pyle.dataking.benchmarking.randomizedBechmarking', 'fitData', lambda f: _wrap(f, 'fitting')),
+               ('scipy.optimize', 'leastsq', lambda f: _wrap(f, 'fitting')),
+               ('scipy.optimize', 'curve_fit', lambda f: _wrap(f, 'fitting')),
+               ('pyle.dataking.sweeps', 'prepDataset', _wrap_datasets),
+               ('pyle.dataking.sweeps', 'grid', _wrap_sweep),
+               ('pyle.dataking.fpgaseqTransmonV7', 'runQubits', lambda f: _wrap_request(f, 'runQubits')),
+               ('matplotlib.pyplot', 'show', lambda f: _wrap(f, 'plotting')),
+               ('matplotlib.pyplot', 'savefig', lambda f: _wrap(f, 'plotting')),
+               ('matplotlib.pyplot', 'pause', lambda f: _wrap(f, 'plotting')),
+               ('pylesim.plotting', 'plotTrajectory', lambda f: _wrap(f, 'plotting'))]
+    for module_name, attr, wrapper in targets:
+        try:
+            module = __import__(module_name, fromlist=[attr])
+        except ImportError:
+            continue
+        if hasattr(module, attr):
+            _patch(module, attr, wrapper(getattr(module, attr)))
+    try:
+        import pylesim.quantsim as sim
+        _patch(sim.QuantumSystem, 'simulate', _wrap(sim.QuantumSystem.simulate.__func__, 'simulate'))
+    except ImportError:
+        pass
+    names = {'runQubits': lambda f: _wrap_request(f, 'runQubits'), 'leastsq': lambda f: _wrap(f, 'fitting'),
+             'curve_fit': lambda f: _wrap(f, 'fitting'), 'plotTrajectory': lambda f: _wrap(f, 'plotting')}
+    for module in modules:
+        for name, wrapper in names.items():
+            if hasattr(module, name):
+                _patch(module, name, wrapper(getattr(module, name)))
+    enabled = True
+
+
+def uninstall():
+    global enabled
+    while _patches:
+        obj, attr, original = _patches.pop()
+        setattr(obj, attr, original)
+    enabled = False
+
+
+class profile(object):
+    # install() for the duration of a with block, the totals are reported (and saved to filename) at the end
+    def __init__(self, *modules, **kw):
+        self.modules = modules
+        self.filename = kw.get('filename')
+
+    def __enter__(self):
+        reset()
+        install(*self.modules)
+        return self
+
+    def __exit__(self, *exc):
+        uninstall()
+        self.result = report(title='total', filename=self.filename)
@@ -0,0 +1,151 @@
+import numpy as np
+import time
+from scipy.linalg import expm
+from scipy.sparse.csgraph import connected_components
+
+# Piecewise-constant propagation: every function here works on stacks of
+# matrices, the time axis is axis -3 and any leading axes are batch axes.
+
+
+def expm_hermitian(H, dt, eig=False):
+    # exp(-1j*H*dt) for every hermitian slice of H, from one batched eigh
+    H = np.asarray(H)
+    if np.iscomplexobj(H) and not np.any(H.imag):
+        # real symmetric stacks (no y drive) diagonalize several times faster
+        H = H.real
+    w, v = np.linalg.eigh(H)
+    phase = np.exp(-1j*w*np.asarray(dt)[..., None])
+    U = np.matmul(v*phase[..., None, :], np.swapaxes(v.conj(), -1, -2))
+    if eig:
+        return U, w, v
+    return U
+
+
+# sigma x, y, z
+PAULI = np.array([[[0, 1], [1, 0]], [[0, -1j], [1j, 0]], [[1, 0], [0, -1]]], dtype=complex)
+
+
+def expm_su2(H, dt):
+    """
+    exp(-1j*H*dt) for stacks of hermitian 2x2 H = h0*I + h.sigma in closed form,
+    exp(-1j*h0*dt)*(cos(|h|dt)*I - 1j*sin(|h|dt)*h.sigma/|h|), no eigendecomposition
+    """
+    H = np.asarray(H)
+    dt = np.asarray(dt)[..., None, None]
+    h0 = 0.5*(H[..., 0, 0]+H[..., 1, 1]).real[..., None, None]
+    K = H-h0*np.eye(2)
+    norm = np.sqrt(np.abs(K[..., 0, 0])**2+np.abs(K[..., 0, 1])**2)[..., None, None]
+    # sin(|h|dt)/|h| without dividing by zero
+    sinc = dt*np.sinc(norm*dt/np.pi)
+    return np.exp(-1j*h0*dt)*(np.cos(norm*dt)*np.eye(2)-1j*sinc*K)
+
+
+def chain(U):
+    """
+    ordered product U[T-1]...U[1]U[0] along axis -3.
+    neighbouring pairs are multiplied together in one batched matmul per level,
+    so a stack of T steps needs log2(T) numpy calls instead of T.
+    """
+    U = np.asarray(U)
+    while U.shape[-3] > 1:
+        if U.shape[-3] % 2:
+            paired = np.matmul(U[..., 1:-1:2, :, :], U[..., 0:-1:2, :, :])
+            U = np.concatenate([paired, U[..., -1:, :, :]], axis=-3)
+        else:
+            U = np.matmul(U[..., 1::2, :, :], U[..., 0::2, :, :])
+    return U[..., 0, :, :]
+
+
+def cumulative(U, reverse=False):
+    """
+    running products along axis -3 with a log2(T)-step scan.
+    forward: C[k] = U[k]...U[0], reverse: C[k] = U[T-1]...U[k]
+    """
+    C = np.array(U)
+    T = C.shape[-3]
+    offset = 1
+    while offset < T:
+        if reverse:
+            C[..., :T-offset, :, :] = np.matmul(C[..., offset:, :, :], C[..., :T-offset, :, :])
+        else:
+            C[..., offset:, :, :] = np.matmul(C[..., offset:, :, :], C[..., :T-offset, :, :])
+        offset *= 2
+    return C
+
+
+def propagate(H, dt):
+    # total unitary of the Hamiltonian stack H (..., T, d, d) with step dt
+    return chain(expm_hermitian(H, dt))
+
+
+def blocks(*Hs):
+    """
+    index arrays of the blocks no H in Hs couples to each other, e.g. the
+    excitation-number sectors of exchange-coupled transmons.
+    """
+    pattern = sum(np.abs(np.asarray(H)) for H in Hs) > 0
+    count, labels = connected_components(pattern, directed=False)
+    return [np.flatnonzero(labels == label) for label in range(count)]
+
+
+def trace_gradient(H, Hc, dt, A):
+    """
+    exact (GRAPE) gradient of Tr = trace(A*Ut) for piecewise-constant H.
+    @param H: Hamiltonian stack (T, d, d)
+    @param Hc: control operators (C, d, d), H[k] depends linearly on u[c, k]*Hc[c]
+    @param A: (d, d) matrix contracted with the total unitary Ut
+    returns Tr and dTr/du with shape (C, T)
+    """
+    dt = float(dt)
+    U, w, v = expm_hermitian(H, dt, eig=True)
+    d = U.shape[-1]
+    I = np.eye(d, dtype=complex)
+    # F[k] = U[k-1]...U[0] and B[k] = U[T-1]...U[k+1]
+    forward = cumulative(U)
+    backward = cumulative(U, reverse=True)
+    F = np.concatenate([I[None], forward[:-1]])
+    B = np.concatenate([backward[1:], I[None]])
+    Tr = np.trace(np.dot(A, forward[-1]))
+    # dexp in the eigenbasis: G[a,b] = (e_a-e_b)/(w_a-w_b), -1j*dt*e_a on the diagonal
+    half_sum = 0.5*(w[:, :, None]+w[:, None, :])*dt
+    half_diff = 0.5*(w[:, :, None]-w[:, None, :])*dt
+    G = -1j*dt*np.exp(-1j*half_sum)*np.sinc(half_diff/np.pi)
+    vh = np.swapaxes(v.conj(), -1, -2)
+    W = np.matmul(np.matmul(vh, np.matmul(F, np.matmul(A, B))), v)
+    Hc_eig = np.matmul(np.matmul(vh[None], np.asarray(Hc)[:, None]), v[None])
+    dTr = np.einsum('tba,tab,ctab->ct', W, G, Hc_eig)
+    return Tr, dTr
+
+
+def _loop_propagate(H, dt):
+    # reference implementation, one expm and one np.dot per step
+    Ut = np.eye(H.shape[-1])
+    for Hi in H:
+        Ut = np.dot(expm(-1j*Hi*dt), Ut)
+    return Ut
+
+
+def benchmark(Ns=[20, 50, 100, 200, 500, 1000, 2000], d=3, repeat=3, seed=0):
+    rs = np.random.RandomState(seed)
+    result = []
+    for N in Ns:
+        A = rs.randn(N, d, d)+1j*rs.randn(N, d, d)
+        H = 0.5*(A+np.swapaxes(A.conj(), -1, -2))
+        t_loop, t_batch = [], []
+        for loop_i in range(repeat):
+            t_start = time.time()
+            U_loop = _loop_propagate(H, 0.1)
+            t_loop.append(time.time()-t_start)
+            t_start = time.time()
+            U_batch = propagate(H, 0.1)
+            t_batch.append(time.time()-t_start)
+        error = np.max(np.abs(U_loop-U_batch))
+        t_loop, t_batch = min(t_loop), min(t_batch)
+        print('N = {:5d}: loop {:.2e} s, batched {:.2e} s, speedup {:6.1f}x, max|dU| = {:.1e}'.format(
+            N, t_loop, t_batch, t_loop/t_batch, error))
+        result.append([N, t_loop, t_batch, error])
+    return np.array(result)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,72 @@
+import numpy as np
+from optimize_3level import qubit3_drive, _cz_infidelity, coups, swaplen
+
+# Fidelity of nominal pulses over a grid of errors: detuning offset [GHz],
+# drive amplitude scale, nonlinearity offset [GHz] and coupling offset [GHz].
+# Every chunk of grid points is propagated as one stack, chunks can be spread
+# over processes.
+
+AXES = ['detuning', 'scale', 'nonlin', 's']
+
+
+def _drag_chunk(args):
+    variable, kw, errors = args
+    alpha, deltaf = variable[0], variable[1]
+    w = kw.get('w', 20.0)
+    drive = qubit3_drive(w=w, t0=kw.get('t0', 10), step=kw.get('step', 0.1), phase=kw.get('phase', 0))
+    P = drive.drag(alpha, deltaf, amp=1.0/w, detuning=errors[:,0], scale=errors[:,1], dnonlin=errors[:,2])
+    return P[:,1]
+
+
+def _cz_chunk(args):
+    x, kw, errors = args
+    X = errors[:,1][:,None]*np.asarray(x, dtype=float)
+    infidelity = _cz_infidelity(X, S=kw.get('S', coups*2), delay=kw.get('delay', swaplen), pulse=kw.get('pulse', 'fourier'),
+                                detuning=errors[:,0], dnonlin=errors[:,2], dS=errors[:,3])
+    return 1-infidelity
+
+
+def sweep(kind, pulses, detuning=[0.0], scale=[1.0], nonlin=[0.0], s=[0.0], chunk=256, pool=None, **kw):
+    """
+    fidelity landscape of nominal pulses over the grid detuning x scale x nonlin x s.
+    @param kind: 'drag' for drag_correct_3level variables [alpha, deltaf] (fidelity P1, s must stay [0.0]),
+        'cz' for cz_phase pulses x (fidelity phi, scale multiplies x)
+    @param pulses: one nominal pulse or a list of them
+    @param chunk: grid points propagated together per job
+    @param pool: anything with a map method to spread the chunks over processes
+    kw are the pulse settings, w/t0/step/phase for 'drag' and S/delay/pulse for 'cz'
+    returns a dict with the axes, the landscape (pulses, detuning, scale, nonlin, s) and
+    per pulse the nominal and worst fidelity, the worst-case errors and the sensitivity
+    (slope, curvature) of the infidelity along every axis through the nominal point.
+    """
+    if kind == 'drag' and np.any(s):
+        raise ValueError('a single qubit drag pulse has no coupling to sweep')
+    func = {'drag': _drag_chunk, 'cz': _cz_chunk}[kind]
+    axes = [np.atleast_1d(np.asarray(a, dtype=float)) for a in (detuning, scale, nonlin, s)]
+    shape = tuple(len(a) for a in axes)
+    errors = np.array([a.ravel() for a in np.meshgrid(*axes, indexing='ij')]).T
+    pulses = np.atleast_2d(pulses)
+    jobs = [(pulse, kw, errors[i:i+chunk]) for pulse in pulses for i in range(0, len(errors), chunk)]
+    if pool is None:
+        result = [func(job) for job in jobs]
+    else:
+        result = pool.map(func, jobs)
+    landscape = np.concatenate(result).reshape((len(pulses),)+shape)
+    # the grid point closest to no error
+    nominal = tuple(np.argmin(np.abs(a-zero)) for a, zero in zip(axes, [0.0, 1.0, 0.0, 0.0]))
+    summary = []
+    for fidelity in landscape:
+        worst = np.unravel_index(np.argmin(fidelity), shape)
+        sensitivity = {}
+        for k, name in enumerate(AXES):
+            if shape[k] < 3:
+                continue
+            cut = list(nominal)
+            cut[k] = slice(None)
+            delta = axes[k]-axes[k][nominal[k]]
+            curvature, slope, offset = np.polyfit(delta, 1-fidelity[tuple(cut)], 2)
+            sensitivity[name] = (slope, 2*curvature)
+        summary.append({'nominal': fidelity[nominal], 'worst': fidelity[worst],
+                        'worst_at': dict((name, axes[k][worst[k]]) for k, name in enumerate(AXES)),
+                        'sensitivity': sensitivity})
+    return {'axes': dict(zip(AXES, axes)), 'landscape': landscape, 'summary': summary}
@@ -1,13 +1,13 @@
 import numpy as np
 from numpy import pi
-from matplotlib import pyplot as plt
-import pylesim.plotting as pyplt
 from scipy import optimize
 from pylesim import envelopes as env
 from pylesim.envelopes import Envelope
-from matplotlib.pyplot import figure
 import pylesim.quantsim as sim
-from pyle.dataking import zfuncs
+from lazy_import import lazy_module
+
+plt = lazy_module('matplotlib.pyplot')
+pyplt = lazy_module('pylesim.plotting')
 
 q0 = sim.Qubit3(T1=50000, T2=40000, nonlin=-0.24)
 q1 = sim.Qubit3(T1=50000, T2=40000, nonlin=-0.2)
@@ -1,11 +1,75 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import pylesim
 import pylesim.quantsim as sim
-import pylesim.plotting as pyplt
 from scipy import optimize
 from pylesim.envelopes import Envelope
-from matplotlib.pyplot import figure
+from lazy_import import lazy_module
+from propagator import PAULI, expm_su2, cumulative, chain
+from sweep2d import sweep2d
+from magnus import drive_components
+
+plt = lazy_module('matplotlib.pyplot')
+pyplt = lazy_module('pylesim.plotting')
+
+def evolve(Hs,dt,psi0,exact=True):
+    """
+    states after every step of the Hamiltonian stack Hs (T,2,2), starting from psi0.
+    the steps are exact exponentials (unitary at any dt, sample Hs at the step midpoints),
+    exact=False takes first order euler steps psi-1j*H*psi*dt instead
+    """
+    if exact:
+        return np.dot(cumulative(expm_su2(Hs,dt)),psi0)
+    steps = np.eye(2)-1j*dt*Hs
+    psiT = np.empty((len(Hs),2),dtype=complex)
+    psit = np.asarray(psi0,dtype=complex)
+    for i in range(len(Hs)):
+        psit = np.dot(steps[i],psit)
+        psiT[i] = psit
+    return psiT
+
+_qubit2_components = {}
+
+def qubit2_components():
+    """
+    H0, Hx, Hy, Hdf of the Qubit2 of evolution_with_theta, H(t) = H0+Re(uw)*Hx+Im(uw)*Hy+df*Hdf
+    """
+    if not _qubit2_components:
+        q = sim.Qubit2(T1=10000,T2=10000)
+        H0,[(Hx,Hy,Hdf)] = drive_components(sim.QuantumSystem([q]),[q])
+        _qubit2_components['H'] = (H0,Hx,Hy,Hdf)
+    return _qubit2_components['H']
+
+def _theta_chunk(args):
+    # final populations for every theta of the chunk, all propagated as one stack
+    Theta,T,m,delta,psi0 = args
+    H0,Hx,Hy,Hdf = qubit2_components()
+    lp = lzpulse(tau0=0,tau1=37.5,taup=m)
+    dt = T[1]-T[0]
+    tm = T[:-1]+dt/2
+    # the envelopes are linear in k0, sample them once for k0 = 1
+    ramp,pi,z = lp._ramp(tm,1.0),lp.pipulse().timeFunc(tm),lp.lzz(k2=1.0).timeFunc(tm)
+    k0 = np.sqrt(delta**2/(1+np.tan(Theta)**2))
+    ux = k0[:,None]*ramp+pi
+    uy = (k0*np.tan(Theta))[:,None]*ramp
+    Hs = H0+ux[...,None,None]*Hx+uy[...,None,None]*Hy+z[:,None,None]*Hdf
+    psi = np.dot(chain(expm_su2(Hs,dt)),psi0)
+    return np.abs(psi)**2
+
+def _taup_row(taup,Theta,settings):
+    # P1 over Theta for one taup, Theta is the axis of evolution_with_theta
+    start,end,step,delta,batched = settings
+    if batched:
+        return _theta_chunk((Theta,np.arange(start,end,step),taup,delta,np.array([0,1+0j])))[:,0]
+    return method(start,end,step).evolution_with_theta(m=taup,delta=delta,output=True,fitting=False)[2]
+
+def _tauc_point(tauc,inner,settings):
+    # final P1 of evolution_with_time for tau1 = (tauc-taup)/2
+    start,end,step,taup = settings
+    T = np.arange(start,end,step)
+    dt = T[1]-T[0]
+    Hs = method().H_series(T+dt/2,n=(tauc-taup)/2.0)
+    psi = np.dot(chain(expm_su2(Hs,dt)),np.array([1+0j,0]))
+    return np.abs(psi[1])**2
 
 class lzpulse(object):
     def __init__(self,tau0=0,tau1=37.5,taup=25):
@@ -20,51 +84,36 @@ class lzpulse(object):
         if self.tau0 >= self.tau1-self.taup/2:
             raise ValueError('tau0 must be less than tau1-taup/2')
 
+    def _ramp(self,t,k):
+        # the piecewise xy ramp of lzx/lzy at every point of t
+        t = np.asarray(t,dtype=float)
+        a,b = self.tau1-self.taup/2,self.tau1+self.taup/2
+        c,d = self.tau2-self.taup/2,self.tau2+self.taup/2
+        conditions = [(self.tau0<=t)&(t<=a),(a<t)&(t<=b),(b<t)&(t<=c),(c<t)&(t<=d),(d<t)&(t<=self.taue)]
+        values = [k*1e-3*(t-self.tau0),(a-self.tau0)*k*1e-3+0*t,-k*1e-3*(t-(self.tau1+self.tau2)/2),
+                  -(a-self.tau0)*k*1e-3+0*t,k*1e-3*(t-self.taue)]
+        n = np.select(conditions,values,0.0)
+        return n if n.ndim else float(n)
+
     def lzx(self,k0=None):
         def timeFunc(t):
-            if self.tau0<=t<=self.tau1-self.taup/2:
-                nx=k0*1e-3*(t-self.tau0)
-            elif self.tau1-self.taup/2<t<=self.tau1+self.taup/2:
-                nx=(self.tau1-self.taup/2-self.tau0)*k0*1e-3
-            elif self.tau1+self.taup/2<t<=self.tau2-self.taup/2:
-                nx=-k0*1e-3*(t-(self.tau1+self.tau2)/2)
-            elif self.tau2-self.taup/2<t<=self.tau2+self.taup/2:
-                nx=-(self.tau1-self.taup/2-self.tau0)*k0*1e-3
-            elif self.tau2+self.taup/2<t<=self.taue:
-                nx=k0*1e-3*(t-self.taue)
-            else:
-                nx=0
-            return nx
+            return self._ramp(t,k0)
         return Envelope(timeFunc,start=self.tau0,end=self.taue)
 
     def lzy(self,k1=None):
         def timeFunc(t):
-            if self.tau0<=t<=self.tau1-self.taup/2:
-                ny=k1*1e-3*(t-self.tau0)
-            elif self.tau1-self.taup/2<t<=self.tau1+self.taup/2:
-                ny=(self.tau1-self.taup/2-self.tau0)*k1*1e-3
-            elif self.tau1+self.taup/2<t<=self.tau2-self.taup/2:
-                ny=-k1*1e-3*(t-(self.tau1+self.tau2)/2)
-            elif self.tau2-self.taup/2<t<=self.tau2+self.taup/2:
-                ny=-(self.tau1-self.taup/2-self.tau0)*k1*1e-3
-            elif self.tau2+self.taup/2<t<=self.taue:
-                ny=k1*1e-3*(t-self.taue)
-            else:
-                ny=0
-            return ny
+            return self._ramp(t,k1)
         return Envelope(timeFunc,start=self.tau0,end=self.taue)
 
     def lzz(self,k2=None):
         def timeFunc(t):
-            if self.tau1-self.taup/2<t<=self.tau1+self.taup/2:
-                m=k2*1e-3*(t-(self.tau1-self.taup/2))
-            elif self.tau1+self.taup/2<t<self.tau2-self.taup/2:
-                m=self.taup*1e-3*k2
-            elif self.tau2-self.taup/2<=t<self.tau2+self.taup/2:
-                m=-k2*1e-3*(t-(self.tau2+self.taup/2))
-            else:
-                m=0
-            return m
+            t = np.asarray(t,dtype=float)
+            a,b = self.tau1-self.taup/2,self.tau1+self.taup/2
+            c,d = self.tau2-self.taup/2,self.tau2+self.taup/2
+            conditions = [(a<t)&(t<=b),(b<t)&(t<c),(c<=t)&(t<d)]
+            values = [k2*1e-3*(t-a),self.taup*1e-3*k2+0*t,-k2*1e-3*(t-d)]
+            m = np.select(conditions,values,0.0)
+            return m if m.ndim else float(m)
             # 1e-3 * k2 * self.taup/2
         return Envelope(timeFunc,start=self.tau0,end=self.taue)
 
@@ -83,10 +132,10 @@ class lzpulse(object):
         plt.figure()
         plt.xlabel('Time[ns]')
         plt.ylabel('Pulse')
-        plt.plot(T,np.array([x.timeFunc(t) for t in T]),'-',label='lzx')
-        plt.plot(T,np.array([y.timeFunc(t) for t in T]),'-.',label='lzy')
-        plt.plot(T,np.array([z.timeFunc(t) for t in T]),'--',label='lzz')
-        plt.plot(T,np.array([p.timeFunc(t) for t in T]),'-',label='pipulse')
+        plt.plot(T,x.timeFunc(T),'-',label='lzx')
+        plt.plot(T,y.timeFunc(T),'-.',label='lzy')
+        plt.plot(T,z.timeFunc(T),'--',label='lzz')
+        plt.plot(T,p.timeFunc(T),'-',label='pipulse')
         plt.legend(loc=1)
         plt.show()
 
@@ -106,6 +155,13 @@ class method(object):
         # return 0.5*((lp.lzx(k0=kx).timeFunc(t)+lp.pipulse(A=A,tau=tau).timeFunc(t))*sigmax+\
         #     lp.lzy(k1=ky).timeFunc(t)*sigmay+lp.lzz(k2=kz).timeFunc(t)*sigmaz)
 
+    def H_series(self,T,kx=4,ky=4,kz=30,n=37.5):
+        # H(t) for every t of T as one (len(T),2,2) array
+        lp = lzpulse(tau0=0,tau1=n,taup=25)
+        T = np.asarray(T,dtype=float)
+        h = np.array([lp._ramp(T,kx),lp._ramp(T,ky),lp.lzz(k2=kz).timeFunc(T)])
+        return 0.5*np.tensordot(h.T,PAULI,axes=1)
+
     def lzfunc(self,theta,s):
         Plz = s
         return 1-4*Plz*(1-Plz)*(np.sin(theta))**2
@@ -117,18 +173,11 @@ class method(object):
         T = np.arange(self.start,self.end,self.step)
         dt = T[1]-T[0]
         psi0 = np.array([1+0j,0])
-        psit = psi0
-        psiT = []
-        rhoT = []
-        for t in T:
-            psit = psit-1j*np.dot(method().H(t,n=tau1),psit)*dt
-            psiT.append(psit)
-            vect = psit.reshape(2,1)
-            rhoT.append(np.dot(vect,np.transpose(vect).conj()))
-        rhoT = np.array(rhoT)
-        psiT = np.array(psiT)
-        pyplt.plotTrajectory(rhoT,state=1,labels=True)
-        plt.show()
+        psiT = evolve(self.H_series(T+dt/2,n=tau1),dt,psi0)
+        if plot:
+            rhoT = psiT[:,:,None]*psiT[:,None,:].conj()
+            pyplt.plotTrajectory(rhoT,state=1,labels=True)
+            plt.show()
         P0 = psiT[:,0]*psiT[:,0].conj()
         P1 = psiT[:,1]*psiT[:,1].conj()
         data = [P0,P1]
@@ -147,26 +196,41 @@ class method(object):
         if output:
             return data
 
-    def  evolution_with_theta(self,display=False,output=False, m=25, delta=10.0, s0 = [0.5],plot=False,fitting=True):
+    def  evolution_with_theta(self,display=False,output=False, m=25, delta=10.0, s0 = [0.5],plot=False,fitting=True,
+                              batched=False,chunk=16,pool=None):
+        """
+        final population P1 against the geometric phase theta and its LZ interference fit
+        @param batched: propagate all theta together as pure states with exact steps instead of one
+            density matrix simulation each (T1 = T2 = 10 us are neglected against the 150 ns pulse),
+            only the final populations are computed and the Rhos entry of the data is None
+        @param chunk: theta values per stack in batched mode
+        @param pool: anything with a map method to spread the chunks over processes
+        """
         T = np.arange(self.start,self.end,self.step)
         Theta = np.arange(0,2*np.pi,0.1)
         psi0 = np.array([0,1+0j])
-        p1 = []
-        Rhos0 = []
-        q = sim.Qubit2(T1=10000,T2=10000)
-        lp = lzpulse(tau0=0,tau1=37.5,taup=m)
-        for th in Theta:
-            k0 = np.sqrt(delta**2/(1+np.tan(th)**2))
-            q.uw=lp.lzx(k0=k0)+1j*lp.lzy(k1=k0*np.tan(th))+lp.pipulse()
-            q.df=lp.lzz(k2=1.0)
-            qsys=sim.QuantumSystem([q])
-            rhos0=qsys.simulate(psi0,T,method='other')
-            Rhos0.append(rhos0)
-        Rhos = np.array(Rhos0)
-        for j in range(len(Theta)):
-            rhos = Rhos[j]
-            p1.append(rhos[:,0][:,0][-1])
-        P1 = np.real(np.array(np.array(p1)))
+        if batched:
+            jobs = [(Theta[i:i+chunk],T,m,delta,psi0) for i in range(0,len(Theta),chunk)]
+            result = map(_theta_chunk,jobs) if pool is None else pool.map(_theta_chunk,jobs)
+            Rhos = None
+            P1 = np.concatenate(result)[:,0]
+        else:
+            p1 = []
+            Rhos0 = []
+            q = sim.Qubit2(T1=10000,T2=10000)
+            lp = lzpulse(tau0=0,tau1=37.5,taup=m)
+            for th in Theta:
+                k0 = np.sqrt(delta**2/(1+np.tan(th)**2))
+                q.uw=lp.lzx(k0=k0)+1j*lp.lzy(k1=k0*np.tan(th))+lp.pipulse()
+                q.df=lp.lzz(k2=1.0)
+                qsys=sim.QuantumSystem([q])
+                rhos0=qsys.simulate(psi0,T,method='other')
+                Rhos0.append(rhos0)
+            Rhos = np.array(Rhos0)
+            for j in range(len(Theta)):
+                rhos = Rhos[j]
+                p1.append(rhos[:,0][:,0][-1])
+            P1 = np.real(np.array(np.array(p1)))
         value = optimize.leastsq(method().residuals,s0,args=(P1,Theta))
         data = [Theta,Rhos,P1,value]
         if plot:
@@ -216,14 +280,16 @@ class method(object):
             print 'P0=',P0,'rho=',data
         return data
 
-    def evolution_with_taup(self,tp0=25,tp1=35,num=10,output=False,imshow=False):
+    def evolution_with_taup(self,tp0=25,tp1=35,num=10,output=False,imshow=False,delta=10.0,batched=False,filename=None,pool=None):
+        """
+        P1 over taup x theta, one evolution_with_theta row per taup
+        @param batched: see evolution_with_theta
+        @param filename: rows are saved there and reused by the next call with the same settings
+        @param pool: anything with a map method to spread the taup rows over processes
+        """
         Taup = np.linspace(tp0,tp1,num)
-        Theta = method().evolution_with_theta(output=True)[0]
-        p1 = []
-        for i in Taup:
-            eth = method().evolution_with_theta(m=i,output=True)
-            p1.append(eth[2])
-        P1 = np.array(p1)
+        Theta = np.arange(0,2*np.pi,0.1)
+        P1 = sweep2d(_taup_row,Taup,Theta,settings=(self.start,self.end,self.step,delta,batched),filename=filename,pool=pool)
         data = [Taup,Theta,P1]
         if imshow:
             lta,lth = len(Taup),len(Theta)
@@ -237,19 +303,17 @@ class method(object):
         if output:
             return data
 
-    def evolution_with_tauc(self,tc0=100,tc1=120,num=200,taup=25,output=False,plot=True):
+    def evolution_with_tauc(self,tc0=100,tc1=120,num=200,taup=25,output=False,plot=True,filename=None,pool=None):
+        # final P1 of evolution_with_time against tauc, filename and pool as in evolution_with_taup
         Tauc = np.linspace(tc0,tc1,num)
-        Tau1 = (Tauc-taup)/2
-        p1 = []
-        for i in Tau1:
-            et = method().evolution_with_time(tau1=i,output=True)[1]
-            p1.append(et[-1])
-        P1 = np.array(p1)
+        P1 = sweep2d(_tauc_point,Tauc,settings=(self.start,self.end,self.step,taup),filename=filename,pool=pool)
         if plot:
             plt.xlabel('Time tauc')
             plt.ylabel('P1')
             plt.plot(Tauc,P1)
             plt.show()
+        if output:
+            return [Tauc,P1]
 
     def plot_bloch(self,test_theta=np.pi/2):
         Theta = np.arange(0,2*np.pi,0.2)
@@ -278,6 +342,52 @@ def P1(Plz=0.6, theta=np.pi*1, plot=True):
         plt.plot(thetaseq, P1)
         plt.show()
 
+def _scalar_lz(lp,t,k,axis):
+    # the point by point definition the envelopes of lzpulse follow
+    a,b = lp.tau1-lp.taup/2,lp.tau1+lp.taup/2
+    c,d = lp.tau2-lp.taup/2,lp.tau2+lp.taup/2
+    if axis == 'z':
+        if a<t<=b:
+            return k*1e-3*(t-a)
+        elif b<t<c:
+            return lp.taup*1e-3*k
+        elif c<=t<d:
+            return -k*1e-3*(t-d)
+        return 0
+    if lp.tau0<=t<=a:
+        return k*1e-3*(t-lp.tau0)
+    elif a<t<=b:
+        return (a-lp.tau0)*k*1e-3
+    elif b<t<=c:
+        return -k*1e-3*(t-(lp.tau1+lp.tau2)/2)
+    elif c<t<=d:
+        return -(a-lp.tau0)*k*1e-3
+    elif d<t<=lp.taue:
+        return k*1e-3*(t-lp.taue)
+    return 0
+
+def check_lzpulse(settings=[(0,37.5,25),(0,37.5,10.0),(5,40,30)],k=[2,0.8,0.5],N=15000):
+    """
+    compare the array envelopes of lzpulse with the point by point definition on a grid of N
+    points plus every segment boundary and its neighbours, returns the largest deviation
+    and prints the time to sample all N points of the three envelopes
+    """
+    import time
+    error = 0.0
+    for tau0,tau1,taup in settings:
+        lp = lzpulse(tau0=tau0,tau1=tau1,taup=taup)
+        edges = np.array([lp.tau0,lp.tau1-lp.taup/2,lp.tau1+lp.taup/2,lp.tau2-lp.taup/2,lp.tau2+lp.taup/2,lp.taue])
+        T = np.concatenate([np.linspace(lp.tau0-5,lp.taue+5,N),edges,np.nextafter(edges,-np.inf),np.nextafter(edges,np.inf)])
+        for env,kk,axis in [(lp.lzx(k0=k[0]),k[0],'x'),(lp.lzy(k1=k[1]),k[1],'y'),(lp.lzz(k2=k[2]),k[2],'z')]:
+            reference = np.array([_scalar_lz(lp,t,kk,axis) for t in T])
+            error = max(error,np.max(np.abs(env.timeFunc(T)-reference)))
+            error = max(error,max(abs(env.timeFunc(t)-_scalar_lz(lp,t,kk,axis)) for t in edges))
+    T = np.linspace(0,150,N)
+    t_start = time.time()
+    x,y,z = lp.lzx(k0=k[0]).timeFunc(T),lp.lzy(k1=k[1]).timeFunc(T),lp.lzz(k2=k[2]).timeFunc(T)
+    print('largest deviation {:.1e}, {} points sampled in {:.1e} s'.format(error,N,time.time()-t_start))
+    return error
+
 if __name__ == '__main__':
     lzpulse().plot_lz(k0=1,k1=0.8,k2=0.5)
     method(start=0,end=150,step=0.01).simuLZ(bloch=True,plot=True,kx=0.28, theta=np.pi/4, kz=0.1)
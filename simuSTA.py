@@ -1,10 +1,12 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import pylesim.quantsim as sim
-import pylesim.plotting as pyplt
 from scipy import optimize
 from pylesim.envelopes import Envelope
-from matplotlib.pyplot import figure
+from lazy_import import lazy_module
+from propagator import PAULI, expm_su2, cumulative
+
+plt = lazy_module('matplotlib.pyplot')
+pyplt = lazy_module('pylesim.plotting')
 
 class STAmethod(object):
 
@@ -55,6 +57,20 @@ class STAmethod(object):
         sigmay=np.array([[0,-1j],[1j,0]],dtype=np.complex)
         return 0.5*dth*sigmay
 
+    def H_series(self, T, m=10, omega0=1):
+        # H0(t)+Hcd(t) for every t of T as one (len(T),2,2) array
+        T = np.asarray(T, dtype=float)
+        thetat = self.thetaf*np.sin(np.pi*T/(2*self.T))
+        omegat = omega0*np.cos(np.pi*T/(m*self.T))
+        dth = self.thetaf*np.pi/(2*self.T)*np.cos((np.pi/2)*T/self.T)
+        h = np.array([omegat*np.sin(thetat), dth, omegat*np.cos(thetat)])
+        return 0.5*np.tensordot(h.T, PAULI, axes=1)
+
+    def propagate(self, T0, psi0):
+        # states after every step of T0, exact step exponentials of H at the step midpoints
+        dt = T0[1]-T0[0]
+        return np.dot(cumulative(expm_su2(self.H_series(T0+dt/2), dt)), psi0)
+
     def eigvect(self, t):
         thetat = self.thetaf*np.sin(np.pi*t/(2*self.T))
         costh2 = np.cos(thetat/2)
@@ -63,14 +79,8 @@ class STAmethod(object):
 
     def evolution_with_time(self, display=False, output=False, plot=True):
         T0 = np.arange(self.start,self.end,self.step)
-        dt = T0[1]-T0[0]
         psi0 = 0.5*np.array([1+0j,1])
-        psit = psi0
-        psiT = []
-        for t in T0:
-            psit=psit-1j*np.dot(STAmethod().H0(t)+STAmethod().Hcd(t),psit)*dt
-            psiT.append(psit)
-        psiT = np.array(psiT)
+        psiT = self.propagate(T0, psi0)
         P0 = psiT[:,0]*psiT[:,0].conj()
         P1 = psiT[:,1]*psiT[:,1].conj()
         data = [P0,P1]
@@ -91,16 +101,9 @@ class STAmethod(object):
 
     def eigen_evolution(self, output=False, plot=True):
         T0 = np.arange(self.start,self.end,self.step)
-        dt = T0[1]-T0[0]
         psi0 = np.array([1+0j,0])
-        psit = psi0
-        psiT = []
-        coth2 = STAmethod().eigvect(t=T0)[0]
-        sith2 = STAmethod().eigvect(t=T0)[1]
-        for t in T0:
-            psit=psit-1j*np.dot(STAmethod().H0(t)+STAmethod().Hcd(t),psit)*dt
-            psiT.append(psit)
-        psiT = np.array(psiT)
+        coth2, sith2 = self.eigvect(t=T0)
+        psiT = self.propagate(T0, psi0)
         Pup = (psiT[:, 0] * coth2 + psiT[:,1]*sith2)*(psiT[:, 0] * coth2 + psiT[:,1]*sith2).conj()
         Pdown = (psiT[:, 0] * -sith2 + psiT[:, 1] * coth2) * (psiT[:, 0] * -sith2 + psiT[:, 1] * coth2).conj()
         data = [Pup,Pdown]
@@ -0,0 +1,214 @@
+import numpy as np
+import time
+import scipy.sparse as sp
+from scipy.linalg import expm
+
+# Sparse Hamiltonians for chains of transmons and resonators, propagated with
+# a Lanczos (Krylov) approximation of exp(-1j*H*dt)*psi that only ever touches
+# the states of interest. The conventions follow pylesim:
+#   H = sum 2*pi*(df*n + nonlin*n*(n-1)/2) + sum pi*s*(a_i^+ a_j + a_i a_j^+)
+#   a drive uw adds pi*(uw*a^+ + conj(uw)*a)
+
+
+def ladder(levels):
+    # annihilation operator of one mode
+    return sp.diags(np.sqrt(np.arange(1, levels)), 1, format='csr', dtype=complex)
+
+
+def embed(op, k, dims):
+    # op acting on mode k of the product space dims
+    left = sp.identity(int(np.prod(dims[:k])), format='csr')
+    right = sp.identity(int(np.prod(dims[k+1:])), format='csr')
+    return sp.kron(sp.kron(left, op), right, format='csr')
+
+
+class SparseSystem(object):
+    def __init__(self, modes, couplers=[]):
+        """
+        @param modes: (levels, df, nonlin) for every transmon or resonator (nonlin=0),
+            df is a frequency in GHz or an Envelope of time
+        @param couplers: (i, j, s) between modes i and j, s in GHz
+        the static part is assembled once as csr, the detunings only enter the diagonal
+        and drives can be set per mode on uw afterwards. a pylesim Qubit3(nonlin=...) is
+        the mode (3, q.df, nonlin), a Resonator the mode (levels, df, 0) and a
+        Coupler(qi, qj, s=s) the coupler (i, j, s); from_pylesim reads them off directly.
+        """
+        self.dims = [levels for levels, df, nonlin in modes]
+        self.df = [df for levels, df, nonlin in modes]
+        self.uw = [None]*len(modes)
+        self.size = int(np.prod(self.dims))
+        a = [embed(ladder(levels), k, self.dims) for k, levels in enumerate(self.dims)]
+        # number operators are diagonal, keep only their diagonals
+        self.n = [np.real(ak.T.conj().dot(ak).diagonal()) for ak in a]
+        self.a = a
+        Hc = sp.csr_matrix((self.size, self.size), dtype=complex)
+        for (levels, df, nonlin), n in zip(modes, self.n):
+            Hc = Hc+sp.diags(2*np.pi*nonlin*n*(n-1)/2.0, format='csr')
+        for i, j, s in couplers:
+            hop = a[i].T.conj().dot(a[j])
+            Hc = Hc+np.pi*s*(hop+hop.T.conj())
+        self.Hc = Hc.tocsr()
+
+    @classmethod
+    def from_pylesim(cls, system, qubits):
+        """
+        the SparseSystem of a pylesim QuantumSystem, read once through magnus.drive_components,
+        with the uw and df envelopes currently set on qubits.
+        @param qubits: every qubit and resonator of system, in the order of system
+        """
+        from magnus import drive_components
+        H0, operators = drive_components(system, qubits)
+        self = cls.__new__(cls)
+        self.n = [np.real(np.diag(Hdf))/(2*np.pi) for Hx, Hy, Hdf in operators]
+        self.dims = [int(round(np.max(n)))+1 for n in self.n]
+        self.size = int(np.prod(self.dims))
+        if self.size != len(H0):
+            raise ValueError('qubits do not span the {} levels of system'.format(len(H0)))
+        # a unit Re(uw) adds pi*(a^+ + a), a is its upper triangle
+        self.a = [sp.triu(sp.csr_matrix(Hx), 1, format='csr')/np.pi for Hx, Hy, Hdf in operators]
+        self.df = [q.df for q in qubits]
+        self.uw = [q.uw for q in qubits]
+        self.Hc = sp.csr_matrix(H0)
+        return self
+
+    def basis(self, *levels):
+        # state vector of the product state |levels[0], levels[1], ...>
+        psi = np.zeros(self.size, dtype=complex)
+        psi[np.ravel_multi_index(levels, self.dims)] = 1.0
+        return psi
+
+    def detuning(self, t):
+        # diagonal 2*pi*sum(df_k(t)*n_k)
+        return 2*np.pi*sum((df(t) if callable(df) else df)*n for df, n in zip(self.df, self.n))
+
+    def H(self, t):
+        H = self.Hc+sp.diags(self.detuning(t), format='csr')
+        for ak, uw in zip(self.a, self.uw):
+            if uw is not None:
+                u = uw(t) if callable(uw) else uw
+                H = H+np.pi*(u*ak.T.conj()+np.conj(u)*ak)
+        return H.tocsr()
+
+    def evolve(self, T, psi0, tol=1e-10):
+        """
+        piecewise-constant evolution over T, H sampled at the step midpoints,
+        every step applied with expm_krylov to the columns of psi0 only.
+        @param psi0: (size,) or (size, k) for k states of interest
+        returns the states at every time of T, (len(T), size) or (len(T), size, k)
+        """
+        psi = np.array(psi0, dtype=complex)
+        states = [psi.copy()]
+        driven = any(uw is not None for uw in self.uw)
+        for t, dt in zip(T[:-1], np.diff(T)):
+            tm = t+dt/2.0
+            if driven:
+                H = self.H(tm)
+                matvec = H.dot
+            else:
+                diagonal = self.detuning(tm)
+                matvec = lambda v: self.Hc.dot(v)+diagonal*v
+            if psi.ndim == 1:
+                psi = expm_krylov(matvec, psi, dt, tol)
+            else:
+                psi = np.array([expm_krylov(matvec, column, dt, tol) for column in psi.T]).T
+            states.append(psi)
+        return np.array(states)
+
+
+def expm_krylov(matvec, psi, dt, tol=1e-10, m_max=40):
+    """
+    exp(-1j*H*dt)*psi from a Lanczos basis of H, grown until the a posteriori
+    error estimate beta_m*|c_m| is below tol. H enters only through matvec(v) = H*v.
+    when m_max vectors do not get there dt is split in two halves, each within tol/2.
+    """
+    beta0 = np.linalg.norm(psi)
+    if beta0 == 0:
+        return psi
+    V = [psi/beta0]
+    alpha, beta = [], []
+    for j in range(m_max):
+        w = matvec(V[j])
+        alpha.append(np.real(np.vdot(V[j], w)))
+        # full reorthogonalization, the basis is short
+        Vj = np.array(V)
+        w = w-np.dot(Vj.T, np.dot(Vj.conj(), w))
+        b = np.linalg.norm(w)
+        if not np.isfinite(b):
+            raise ValueError('H*psi is not finite')
+        T = np.diag(alpha)+np.diag(beta, 1)+np.diag(beta, -1)
+        e, v = np.linalg.eigh(T)
+        c = np.dot(v*np.exp(-1j*e*dt), v[0].conj())
+        if b*abs(c[-1]) < tol or b < 1e-14:
+            return beta0*np.dot(np.array(V).T, c)
+        beta.append(b)
+        V.append(w/b)
+    half = expm_krylov(matvec, psi, dt/2.0, tol/2.0, m_max)
+    return expm_krylov(matvec, half, dt/2.0, tol/2.0, m_max)
+
+
+def transmon_chain(qubits=3, resonator=0, levels=3, s=0.02, nonlin=-0.24, df=5.5, spread=0.4):
+    # qubits transmons coupled in a chain, optionally all coupled to a resonator with resonator levels,
+    # the modes of Qubit3s (levels=3) and a Resonator as in SparseSystem, without building them in pylesim
+    modes = [(levels, df-spread*k/max(qubits-1, 1), nonlin) for k in range(qubits)]
+    couplers = [(k, k+1, s) for k in range(qubits-1)]
+    if resonator:
+        modes.append((resonator, df+0.3, 0.0))
+        couplers += [(k, qubits, s) for k in range(qubits)]
+    return SparseSystem(modes, couplers)
+
+
+def check_cz(S=0.02, x=np.array([-0.18,-0.0,-0.0,-0.0,-0.0,-0.0,-0.0])):
+    """
+    the two Qubit3 CZ problem assembled here against optimize_3level.cz_components and
+    from_pylesim, which read the Hamiltonian off pylesim: largest deviation of H and of
+    the final computational states.
+    """
+    import optimize_3level as o
+    H0, Hq0, Hq1 = o.cz_components(S)
+    system = SparseSystem([(3, 0.0, o.nonlin), (3, 0.0, o.nonlin)], [(0, 1, S)])
+    q0, q1 = o.sim.Qubit3(nonlin=o.nonlin), o.sim.Qubit3(nonlin=o.nonlin)
+    read = SparseSystem.from_pylesim(o.sim.QuantumSystem([q0, q1], [o.sim.Coupler(q0, q1, s=S)]), [q0, q1])
+    dH = max(np.max(np.abs(read.Hc.toarray()-system.Hc.toarray())),
+             max(np.max(np.abs((ar-ak).toarray())) for ar, ak in zip(read.a, system.a)),np.max(np.abs(system.Hc.toarray()-H0)), np.max(np.abs(np.diag(2*np.pi*system.n[0])-Hq0)),
+             np.max(np.abs(np.diag(2*np.pi*system.n[1])-Hq1)))
+    delay = o.swaplen
+    f0 = 5.66+np.dot(o.cz_basis(delay), x)
+    system.df = [lambda t: np.interp(t, delay, f0), 5.24]
+    psi0 = np.eye(9)[:, [0, 1, 3, 4]]
+    sparse = system.evolve(delay, psi0)[-1]
+    dt = delay[1]-delay[0]
+    fm = np.interp(delay[:-1]+dt/2.0, delay, f0)
+    dense = o.propagate(H0+fm[:, None, None]*Hq0+5.24*Hq1, dt)[:, [0, 1, 3, 4]]
+    return dH, np.max(np.abs(sparse-dense))
+
+
+def benchmark(sizes=[(2, 0), (3, 0), (4, 0), (4, 3)], steps=200, dt=0.1):
+    """
+    dense expm per step against the sparse Krylov step on transmon chains
+    (qubits, resonator levels), evolving one initial state under a z pulse.
+    """
+    result = []
+    for qubits, resonator in sizes:
+        system = transmon_chain(qubits, resonator)
+        system.df[0] = lambda t, f=system.df[0]: f+0.1*np.sin(2*np.pi*t/(steps*dt))
+        T = np.arange(steps+1)*dt
+        psi0 = system.basis(*([1]*2+[0]*(len(system.dims)-2)))
+        t_start = time.time()
+        psi_sparse = system.evolve(T, psi0)[-1]
+        t_sparse = time.time()-t_start
+        t_start = time.time()
+        psi = psi0
+        for t in T[:-1]:
+            psi = np.dot(expm(-1j*system.H(t+dt/2.0).toarray()*dt), psi)
+        t_dense = time.time()-t_start
+        memory_dense = 16*system.size**2
+        memory_sparse = system.Hc.data.nbytes+system.Hc.indices.nbytes+system.Hc.indptr.nbytes
+        error = np.max(np.abs(psi-psi_sparse))
+        print('{:4d} levels: dense {:.2e} s {:9d} B, sparse {:.2e} s {:7d} B, max|dpsi| = {:.1e}'.format(
+            system.size, t_dense, memory_dense, t_sparse, memory_sparse, error))
+        result.append([system.size, t_dense, t_sparse, memory_dense, memory_sparse, error])
+    return np.array(result)
+
+
+if __name__ == '__main__':
+    benchmark()
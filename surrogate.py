@@ -0,0 +1,163 @@
+import numpy as np
+from scipy.stats import norm
+
+
+class Surrogate(object):
+    def __init__(self, f, model='gp', kappa=3.0, min_points=None, noise=1e-4, maxpoints=200, max_skips=5):
+        """
+        response-surface front for an expensive objective f(x), fitted to every real evaluation.
+        a point is only sent to f when its lower confidence bound mean-kappa*std could beat the
+        best value measured so far, otherwise the prediction is returned. skipped points are
+        therefore always predicted worse than the best one, so an optimizer never settles on one.
+        wrap f where the optimizer is called: nelder_mead(Surrogate(cz_phase), x0) or
+        nelder_mead_parallel(Surrogate(cz_phase), x0, pool=pool). finite-difference gradients of
+        find_optimize then partly come from the model, pass fprime if f has an exact gradient.
+        @param model: 'gp' (gaussian process, squared exponential kernel) or 'quadratic' (full quadratic least squares)
+        @param kappa: width of the confidence bound in standard deviations, larger calls f more often
+        @param min_points: real evaluations before the model is trusted, defaults to the points a quadratic needs
+        @param noise: observation noise variance relative to the variance of the values, e.g. for measured fidelities
+        @param maxpoints: the model is fitted to the best maxpoints evaluations
+        @param max_skips: after this many skips in a row the next point is evaluated anyway, a
+            confidently wrong model can otherwise hide every improvement from the optimizer
+        """
+        self.f = f
+        self.model = model
+        self.kappa = kappa
+        self.min_points = min_points
+        self.noise = noise
+        self.maxpoints = maxpoints
+        self.max_skips = max_skips
+        self.in_a_row = 0
+        self.X, self.y = [], []
+        self.fitted = None
+        self.calls = 0
+        self.skipped = 0
+
+    def add(self, x, y):
+        # a real evaluation, e.g. from an earlier session
+        self.X.append(np.asarray(x, dtype=float).ravel())
+        self.y.append(float(y))
+        self.fitted = None
+
+    def ready(self):
+        if self.min_points is not None:
+            return len(self.y) >= self.min_points
+        d = len(self.X[0]) if self.X else 0
+        return d > 0 and len(self.y) >= (d+1)*(d+2)//2
+
+    def fit(self):
+        keep = np.argsort(self.y)[:self.maxpoints]
+        X, y = np.array(self.X)[keep], np.array(self.y)[keep]
+        if self.model == 'gp':
+            self.fitted = self._fit_gp(X, y)
+        else:
+            self.fitted = self._fit_quadratic(X, y)
+        return self.fitted
+
+    def _fit_gp(self, X, y):
+        # length scales from the spread of the points, the overall factor by maximum likelihood
+        mean, scale = np.mean(y), np.std(y) or 1.0
+        r = (y-mean)/scale
+        spread = np.maximum(np.std(X, axis=0), 1e-12)
+        best = None
+        for factor in [0.25, 0.5, 1.0, 2.0, 4.0]:
+            length = factor*spread
+            K = self._kernel(X, X, length)+(self.noise+1e-10)*np.eye(len(X))
+            try:
+                L = np.linalg.cholesky(K)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(L.T, np.linalg.solve(L, r))
+            likelihood = -0.5*np.dot(r, alpha)-np.sum(np.log(np.diag(L)))
+            if best is None or likelihood > best[0]:
+                best = (likelihood, length, L, alpha)
+        likelihood, length, L, alpha = best
+        return {'X': X, 'mean': mean, 'scale': scale, 'length': length, 'L': L, 'alpha': alpha}
+
+    def _kernel(self, A, B, length):
+        d = (A[:, None, :]-B[None, :, :])/length
+        return np.exp(-0.5*np.sum(d*d, axis=-1))
+
+    def _features(self, X):
+        X = np.atleast_2d(X)
+        i, j = np.triu_indices(X.shape[1])
+        return np.hstack([np.ones((len(X), 1)), X, X[:, i]*X[:, j]])
+
+    def _fit_quadratic(self, X, y):
+        A = self._features(X)
+        coef, res, rank, sv = np.linalg.lstsq(A, y, rcond=None)
+        dof = max(len(y)-A.shape[1], 1)
+        sigma2 = np.sum((np.dot(A, coef)-y)**2)/dof
+        return {'coef': coef, 'sigma2': sigma2, 'cov': np.linalg.pinv(np.dot(A.T, A))}
+
+    def predict(self, X):
+        # mean and standard deviation of the model at the rows of X
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        m = self.fitted or self.fit()
+        if self.model == 'gp':
+            k = self._kernel(X, m['X'], m['length'])
+            v = np.linalg.solve(m['L'], k.T)
+            var = np.maximum(1.0-np.sum(v*v, axis=0), 0.0)
+            return m['mean']+m['scale']*np.dot(k, m['alpha']), m['scale']*np.sqrt(var)
+        A = self._features(X)
+        var = m['sigma2']*(1.0+np.sum(np.dot(A, m['cov'])*A, axis=1))
+        return np.dot(A, m['coef']), np.sqrt(var)
+
+    def skip(self, x):
+        # the predicted value when x can be skipped, otherwise None
+        if not self.ready() or self.in_a_row >= self.max_skips:
+            self.in_a_row = 0
+            return None
+        mean, std = self.predict(x)
+        if mean[0]-self.kappa*std[0] > min(self.y):
+            self.in_a_row += 1
+            return mean[0]
+        self.in_a_row = 0
+        return None
+
+    def __call__(self, x):
+        self.calls += 1
+        value = self.skip(x)
+        if value is not None:
+            self.skipped += 1
+            return value
+        value = self.f(x)
+        self.add(x, value)
+        return value
+
+    def map(self, xs, pool=None):
+        # decide for the whole batch against the current model, only the rest is sent to f
+        values = [self.skip(x) for x in xs]
+        todo = [i for i, value in enumerate(values) if value is None]
+        if pool is None:
+            new = [self.f(xs[i]) for i in todo]
+        else:
+            new = list(pool.map(self.f, [xs[i] for i in todo]))
+        for i, value in zip(todo, new):
+            self.add(xs[i], value)
+            values[i] = value
+        self.calls += len(xs)
+        self.skipped += len(xs)-len(todo)
+        return values
+
+    def propose(self, n=1, candidates=2000, margin=0.1, seed=None):
+        """
+        n points of largest expected improvement among random candidates in the box around
+        the evaluated points widened by margin, e.g. to restart an optimizer or fill a pool.
+        """
+        rs = np.random.RandomState(seed)
+        X = np.array(self.X)
+        low, high = X.min(axis=0), X.max(axis=0)
+        width = np.maximum(high-low, 1e-12)
+        C = low-margin*width+rs.rand(candidates, X.shape[1])*(1+2*margin)*width
+        mean, std = self.predict(C)
+        z = (min(self.y)-mean)/np.maximum(std, 1e-300)
+        improvement = (min(self.y)-mean)*norm.cdf(z)+std*norm.pdf(z)
+        return C[np.argsort(-improvement)[:n]]
+
+    def stats(self):
+        return {'calls': self.calls, 'evaluations': len(self.y), 'skipped': self.skipped,
+                'skip_rate': float(self.skipped)/self.calls if self.calls else 0.0}
+
+    def report(self):
+        print('surrogate: {calls} calls, {evaluations} evaluations, {skipped} skipped ({skip_rate:.1%})'.format(**self.stats()))
@@ -2,10 +2,7 @@ import numpy as np
 import pyle
 import copy
 import time
-import labrad
 from labrad.units import Unit
-from matplotlib import mlab
-from matplotlib import pyplot as plt
 from pyle import envelopes as env
 from pyle import gateCompiler as gc
 from pyle import gates
@@ -27,24 +24,32 @@ import math
 from scipy.optimize import leastsq
 from pyle.dataking import utilMultilevels as ml
 from scipy.integrate import quad
-from pyle.plotting import dstools
-from pyle.plotting import tomography as tg
 from pyle import tomo
 from pyle.analysis.stateTomography import correctVisibility
 from pyle.pipeline import FutureList
 from pyle.math import ket2rho, fidelity
 from pyle.datavault import DataVaultWrapper
-from pyle.plotting.tomography import plotTrajectory
 from pyle.math import dot3
 from pyle.dataking import singleQubitTransmon as sq
 import sys
 #sys.path.append('D:\DatakingCodes\zzwpyle\ABC')
-import swiphttest as sw
-from pyle.workflow import switchSession
-import lz
+from lazy_import import lazy_module
+from checkpoint import Checkpoint
+from telemetry import Telemetry, PrintSink, LivePlot, Timed, simplex_record
 from random import choice
 import pyle.optimize as popt
 
+# plotting, gate modules and the session helper are only loaded when used
+plt = lazy_module('matplotlib.pyplot')
+dstools = lazy_module('pyle.plotting.dstools')
+tg = lazy_module('pyle.plotting.tomography')
+sw = lazy_module('swiphttest')
+lz = lazy_module('lz')
+
+def switchSession(*args, **kw):
+    from pyle.workflow import switchSession
+    return switchSession(*args, **kw)
+
 qubit_config = ['q3', 'q4']
 
 FBC_ENABLE = False
@@ -2095,104 +2100,136 @@ def f_target(CZparameter, Sample, measure=(0,1), single_m=10, k=30, interleaved=
     return 1-probality_now
 
 def nelder_mead_cz(Sample, measure=(0,1), single_m=10, k=30, name='test nelder-mead CZ', interleaved=False, save=True, update=False,
-    x_start=np.array([-0.36,-0.11,0.042]), step=[0.1,0.1,0.05], error=0.01, max_attempts=20, max_iter=50, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5):
+    x_start=np.array([-0.36,-0.11,0.042]), step=[0.1,0.1,0.05], error=0.01, max_attempts=20, max_iter=50, alpha=1.0, gamma=2.0, rho=0.5, sigma=0.5,
+    cache=None, surrogate=None, checkpoint=None, resume=True, callback=None, plot=True):
+    # cache: True keeps measured points in memory, a filename also keeps them between sessions
+    # checkpoint: file keeping the simplex and every measured point, run again with it to resume (resume=False starts over)
+    # surrogate: True or a dict of Surrogate options, skips measuring points the model is confident are worse
+    # callback: gets a telemetry record per iteration, by default printed and plotted in the background
+    from objective_cache import ObjectiveCache
+    from surrogate import Surrogate
+    def objective(x):
+        return f_target(CZparameter=x, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
+    cp = None
+    if checkpoint:
+        cp = Checkpoint(checkpoint, resume=resume)
+        objective = cp.wrap(objective)
+    wrappers = []
+    if cache:
+        objective = ObjectiveCache(objective, filename=None if cache is True else cache)
+        wrappers.append(objective)
+    if surrogate:
+        objective = Surrogate(objective, **({} if surrogate is True else surrogate))
+        wrappers.append(objective)
+    timed = Timed(objective)
+    own_callback = callback is None
+    if own_callback:
+        sinks = [PrintSink(fmt='\033[1;35;1m best probs_fit value of cz so far: {fidelity} \033[0m\n'
+                             '\033[1;35;1m best cz parameters so far: {x} \033[0m')]
+        if plot:
+            sinks.append(LivePlot(key='fidelity', ylabel='fidelity', logy=False))
+        callback = Telemetry(*sinks)
     # initial
     dim = len(x_start)
-    prev_best = f_target(CZparameter=x_start, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
-    attempts_num = 0
-    response = [[x_start, prev_best]]
-
-    for i in range(dim):
-        x = copy.copy(x_start)
-        x[i] = x[i] + step[i]
-        score = f_target(CZparameter=x, Sample=Sample, measure=measure, single_m=single_m,
-            k=k, interleaved=interleaved)
-        response.append([x, score])
-    # simplex iter
-    iters = 0
-    plt.ion()
-    fig = plt.figure()
-    ax = fig.add_subplot(1,1,1)
-    ax.set_ylabel('fidelity')
-    ax.set_xlabel('iterations')
-    while 1:
-        # order
-        response.sort(key=lambda x: x[1])
-        best = response[0][1]
-        # break after max_iter
-        if max_iter and iters >= max_iter:
-            print 'maximum number of iterations has been reached'
-            if save or update:
-                f_target(CZparameter=response[0][0], Sample=Sample, measure=measure, single_m=single_m, k=k,
-                    interleaved=interleaved, name=name, save=save, update=update)
-            return 1-response[0][1]
-        iters += 1
-        ax.plot(iters,1-best,'o',color='k')
-        plt.pause(0.1)
-        # break after max_attempts iterations with no improvement
-        time.sleep(0.1)
-        print('\033[1;35;1m best probs_fit value of cz so far: {} \033[0m').format(1-best)
-        print('\033[1;35;1m best cz parameters so far: {} \033[0m').format(response[0][0])
-
-        if prev_best - best > error:
-            attempts_num = 0
-            prev_best = best
-        else:
-            attempts_num += 1
-        if attempts_num >= max_attempts:
-            print 'number of iterations:',iters
-            print 'current optimal solution within max_attempts is {}'.format(1-response[0][1])
-            print 'the final cz parameters is',response[0][0]
-            if save or update:
-                f_target(CZparameter=response[0][0], Sample=Sample, measure=measure, single_m=single_m, k=k,
-                    interleaved=interleaved, name=name, save=save, update=update)
-            return 1-response[0][1]
-
-        # centroid
-        x0 = [0.0] * dim
-        for tup in response[:-1]:
-            for i, c in enumerate(tup[0]):
-                x0[i] += c / (len(response)-1)
-        # reflection
-        xr = x0 + alpha*(x0 - response[-1][0])
-        rscore = f_target(CZparameter=xr, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
-        if response[0][1] <= rscore < response[-2][1]:
-            print 'reflection is running ...'
-            del response[-1]
-            response.append([xr, rscore])
-            continue
-        # expansion
-        if rscore < response[0][1]:
-            print 'expansion is running ...'
-            xe = x0 + gamma*(xr - x0)
-            escore = f_target(CZparameter=xe, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
-            if escore < rscore:
-                del response[-1]
-                response.append([xe, escore])
-                continue
+    if cp is not None and cp.state is not None:
+        response, iters, prev_best, attempts_num, operation = [cp.state[key] for key in
+            ['response', 'iters', 'prev_best', 'attempts_num', 'operation']]
+    else:
+        prev_best = timed(x_start)
+        attempts_num = 0
+        response = [[x_start, prev_best]]
+
+        for i in range(dim):
+            x = copy.copy(x_start)
+            x[i] = x[i] + step[i]
+            score = timed(x)
+            response.append([x, score])
+        # simplex iter
+        iters = 0
+        operation = 'init'
+    try:
+        while 1:
+            # order
+            response.sort(key=lambda x: x[1])
+            if cp is not None:
+                cp.save({'response': response, 'iters': iters, 'prev_best': prev_best,
+                         'attempts_num': attempts_num, 'operation': operation})
+            best = response[0][1]
+            # break after max_iter
+            if max_iter and iters >= max_iter:
+                print 'maximum number of iterations has been reached'
+                if save or update:
+                    f_target(CZparameter=response[0][0], Sample=Sample, measure=measure, single_m=single_m, k=k,
+                        interleaved=interleaved, name=name, save=save, update=update)
+                for wrapper in wrappers:
+                    wrapper.report()
+                return 1-response[0][1]
+            iters += 1
+            callback(simplex_record(iters, response, operation, timed, fidelity=1-best))
+            # break after max_attempts iterations with no improvement
+            if prev_best - best > error:
+                attempts_num = 0
+                prev_best = best
             else:
+                attempts_num += 1
+            if attempts_num >= max_attempts:
+                print 'number of iterations:',iters
+                print 'current optimal solution within max_attempts is {}'.format(1-response[0][1])
+                print 'the final cz parameters is',response[0][0]
+                if save or update:
+                    f_target(CZparameter=response[0][0], Sample=Sample, measure=measure, single_m=single_m, k=k,
+                        interleaved=interleaved, name=name, save=save, update=update)
+                for wrapper in wrappers:
+                    wrapper.report()
+                return 1-response[0][1]
+
+            # centroid
+            x0 = [0.0] * dim
+            for tup in response[:-1]:
+                for i, c in enumerate(tup[0]):
+                    x0[i] += c / (len(response)-1)
+            # reflection
+            xr = x0 + alpha*(x0 - response[-1][0])
+            rscore = timed(xr)
+            if response[0][1] <= rscore < response[-2][1]:
+                operation = 'reflection'
                 del response[-1]
                 response.append([xr, rscore])
                 continue
-        # contraction
-        if rscore >= response[-2][1]:
-            print 'contraction is running ...'
-            xc = x0 + rho*(response[-1][0]-x0)
-            cscore = f_target(CZparameter=xc, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
-            if cscore < response[-1][1]:
-                del response[-1]
-                response.append([xc, cscore])
-                continue
-        # shrink
-        print 'shrink is running ...'
-        x1 = response[0][0]
-        nresponse = [[x1, response[0][1]]]
-        for tup in response[1:]:
-            xi = x1 + sigma*(tup[0] - x1)
-            score = f_target(CZparameter=xi, Sample=Sample, measure=measure, single_m=single_m, k=k, interleaved=interleaved)
-            nresponse.append([xi, score])
-        response = nresponse
-    plt.ioff()
+            # expansion
+            if rscore < response[0][1]:
+                operation = 'expansion'
+                xe = x0 + gamma*(xr - x0)
+                escore = timed(xe)
+                if escore < rscore:
+                    del response[-1]
+                    response.append([xe, escore])
+                    continue
+                else:
+                    del response[-1]
+                    response.append([xr, rscore])
+                    continue
+            # contraction
+            if rscore >= response[-2][1]:
+                operation = 'contraction'
+                xc = x0 + rho*(response[-1][0]-x0)
+                cscore = timed(xc)
+                if cscore < response[-1][1]:
+                    del response[-1]
+                    response.append([xc, cscore])
+                    continue
+            # shrink
+            operation = 'shrink'
+            x1 = response[0][0]
+            nresponse = [[x1, response[0][1]]]
+            for tup in response[1:]:
+                xi = x1 + sigma*(tup[0] - x1)
+                score = timed(xi)
+                nresponse.append([xi, score])
+            response = nresponse
+    finally:
+        if own_callback:
+            callback.close()
 
 def testFermionicModel(Sample, measure=(0,1), steps=range(1,9), delay=st.r[0:30:5, ns], stats=1200, tBuf=10*ns,
                   name='test Fermionic Model', save=True, correctXtalkZ=True, correlated=False, noisy=True):
@@ -2310,7 +2347,10 @@ def test_1qubit_QST_2level(Sample, measure=0,  init=('I'), stats=1200, time=st.r
     return data
 
 
-def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_num=10, corrrection=True, error=0.1, m_max=20, m_points=3, k=20, interleaved=False, maxtime=14*us, name='optimize zpulse', stats=600, plot=True, save=False, noisy=False):
+def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_num=10, corrrection=True, error=0.1, m_max=20, m_points=3, k=20, interleaved=False, maxtime=14*us, name='optimize zpulse', stats=600, plot=True, save=False, noisy=False,
+    checkpoint=None, resume=True):
+    # checkpoint: file keeping the measured RB data, settling parameters and sign guesses after every count,
+    # run again with it to continue from the last finished count (resume=False starts over)
 
     sample, devs, qubits, Qubits = gc.loadQubits(Sample, measure, True)
     rbClass = rb.RBClifford(2, False)
@@ -2330,6 +2370,8 @@ def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_n
     kw = {"stats": stats, "interleaved": interleaved, 'k': k, 'axismode': 'm', "maxtime": maxtime}
 
     dataset = sweeps.prepDataset(sample, name, axes, deps, measure=measure, kw=kw)
+    cp = Checkpoint(checkpoint, resume=resume) if checkpoint else None
+    state = cp.state if cp is not None else None
 
     def func(server, currM, currK):
         print("m = {m}, k = {k}".format(m=currM, k=currK))
@@ -2343,18 +2385,23 @@ def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_n
         data = yield runQubits(server, alg.agents, stats, dataFormat='iqRaw')
         probs = np.squeeze(readout.iqToProbs(data, alg.qubits, states=[0, 1], correlated=True)).flat
         returnValue([probs[0]])
-    data = sweeps.grid(func, axes, dataset=dataset, save=False, noisy=noisy)
-    probality_init = np.mean(data[:,2][:k])
-
-    if probality_init < 0.1:
-        print 'probality_init =', probality_init
-        raise Exception("init parameter is too bad")
-    ms, ks, probs = dstools.format2D(data)
-    prob_mean = np.mean(probs, axis=0)
-    prob_std = np.std(probs, axis=0)
-    p0 = [0.99, np.max(prob_mean)-np.min(prob_mean), np.min(prob_mean)]
-    ans = rb.fitData(ms, prob_mean, A=None, B=None, p0=p0)
-    probs_fit = ans['p']
+    if state is None:
+        data = sweeps.grid(func, axes, dataset=dataset, save=False, noisy=noisy)
+        probality_init = np.mean(data[:,2][:k])
+
+        if probality_init < 0.1:
+            print 'probality_init =', probality_init
+            raise Exception("init parameter is too bad")
+        ms, ks, probs = dstools.format2D(data)
+        prob_mean = np.mean(probs, axis=0)
+        prob_std = np.std(probs, axis=0)
+        p0 = [0.99, np.max(prob_mean)-np.min(prob_mean), np.min(prob_mean)]
+        ans = rb.fitData(ms, prob_mean, A=None, B=None, p0=p0)
+        probs_fit = ans['p']
+        if cp is not None:
+            cp.save({'data': data, 'probs_fit': probs_fit})
+    else:
+        data, probs_fit = state['data'], state['probs_fit']
     count = 0
     probs_all, data_all = [probs_fit], [data]
     print '{}, probs_init is {}'.format('init data is finished', probs_fit)
@@ -2370,8 +2417,33 @@ def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_n
             Rates0, Amplitudes0 = Q['settlingRates'][0], Q['settlingAmplitudes'][0]
             Rates1, Amplitudes1 = Q['settlingRates'][1], Q['settlingAmplitudes'][1]
         sign_all, new_sign = [sign_guess],[]
-
-        for loop_i in range(test_num):
+        sign_guess_new = sign_guess
+
+        def zpulse_state(loop_i, finished=False):
+            # everything the next count depends on
+            rates = [Rates0] if len(Q['settlingRates']) == 1 else [Rates0, Rates1]
+            amplitudes = [Amplitudes0] if len(Q['settlingRates']) == 1 else [Amplitudes0, Amplitudes1]
+            return {'data': data, 'probs_fit': probs_fit, 'loop_i': loop_i, 'finished': finished, 'count': count,
+                    'rates': rates, 'amplitudes': amplitudes, 'probs_all': probs_all, 'data_all': data_all,
+                    'settlingRates': settlingRates, 'settlingAmplitudes': settlingAmplitudes,
+                    'sign_all': sign_all, 'new_sign': new_sign, 'sign_guess_new': sign_guess_new,
+                    'data_final': data_final, 'settlingRates_final': settlingRates_final,
+                    'settlingAmplitudes_final': settlingAmplitudes_final}
+
+        start = 0
+        if state is not None and 'loop_i' in state:
+            start = test_num if state['finished'] else state['loop_i']+1
+            count, probs_all, data_all = state['count'], state['probs_all'], state['data_all']
+            settlingRates, settlingAmplitudes = state['settlingRates'], state['settlingAmplitudes']
+            sign_all, new_sign, sign_guess_new = state['sign_all'], state['new_sign'], state['sign_guess_new']
+            data_final = state['data_final']
+            settlingRates_final, settlingAmplitudes_final = state['settlingRates_final'], state['settlingAmplitudes_final']
+            Rates0, Amplitudes0 = state['rates'][0], state['amplitudes'][0]
+            if len(Q['settlingRates']) == 2:
+                Rates1, Amplitudes1 = state['rates'][1], state['amplitudes'][1]
+            print 'resuming at count = {}'.format(count+1)
+
+        for loop_i in range(start, test_num):
             count += 1
             print('\033[1;35;1m count = {} \033[0m').format(count)
             if loop_i == 0:
@@ -2435,6 +2507,8 @@ def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_n
 
             if probs_fit_i > 1-error:
                 print 'error value is within the set range'
+                if cp is not None:
+                    cp.save(zpulse_state(loop_i, finished=True))
                 break
             if loop_i < 0: # no actual meaning just adapt synatx rules
                 sign_guess_new = sign_guess
@@ -2491,6 +2565,8 @@ def optimize_zpulse_gate(Sample, measure=(0,1), factor=[0.1,0.1,0.1,0.1], test_n
                 print 'sign_guess_new'+str(loop_i+1)+' =', sign_guess_new
 
                 break
+            if cp is not None:
+                cp.save(zpulse_state(loop_i))
     else:
         data_final = data
         settlingRates_final = settlingRates[0]
@@ -0,0 +1,55 @@
+import itertools
+import numpy as np
+from objective_cache import atomic_dump, atomic_load
+
+# Row by row parameter sweeps of the simulations. One call of func computes a
+# whole row of the inner axis (e.g. all geometric phases for one taup), rows go
+# into one preallocated array as they arrive and, with a filename, to disk, so
+# an interrupted or extended sweep only computes the rows it does not have yet.
+
+
+def _row(args):
+    func, x, inner, settings = args
+    return func(x, inner, settings)
+
+
+def sweep2d(func, outer, inner=None, settings=None, filename=None, pool=None, decimals=10):
+    """
+    func(x, inner, settings) for every x of outer, returning the row of len(inner) values
+    (one value when inner is None). func must be a module level function when a pool is used.
+    every distinct x is computed once. rows saved in filename under the same inner axis and
+    settings are reused, the others are computed and added to the file as they finish.
+    @param settings: everything else the rows depend on, picklable and comparable with ==
+    @param pool: anything with a map method (imap is used when there is one) to spread the rows
+    returns an array (len(outer), len(inner)), or (len(outer),) when inner is None
+    """
+    outer = np.asarray(outer, dtype=float)
+    shape = (len(outer),) if inner is None else (len(outer), len(inner))
+    result = np.empty(shape)
+    rows = {}
+    saved = atomic_load(filename) if filename is not None else None
+    if saved is not None:
+        if saved['settings'] == settings and np.array_equal(saved['inner'], inner):
+            rows = saved['rows']
+        else:
+            print('{} holds another sweep, starting over'.format(filename))
+    keys = [round(x, decimals) for x in outer]
+    where = {}
+    for i, key in enumerate(keys):
+        where.setdefault(key, []).append(i)
+    todo = [key for key in sorted(where, key=lambda key: where[key][0]) if key not in rows]
+    for key in where:
+        if key in rows:
+            result[where[key]] = rows[key]
+    jobs = [(func, outer[where[key][0]], inner, settings) for key in todo]
+    if pool is None:
+        rows_done = itertools.imap(_row, jobs)
+    else:
+        rows_done = getattr(pool, 'imap', pool.map)(_row, jobs)
+    for key, row in itertools.izip(todo, rows_done):
+        result[where[key]] = row
+        rows[key] = row
+        if filename is not None:
+            atomic_dump({'settings': settings, 'inner': inner, 'rows': rows}, filename)
+    print('sweep: {} rows computed, {} reused'.format(len(todo), len(where)-len(todo)))
+    return result
@@ -0,0 +1,184 @@
+import numpy as np
+import json
+import time
+import threading
+import multiprocessing
+import Queue
+
+# Optimizer loops only put records on a queue; printing, logging and plotting
+# happen in a background thread (and the live plot in its own process), so the
+# loop never waits on the terminal or the GUI.
+
+
+class Timed(object):
+    # objective wrapper counting evaluations and the wall time spent inside f
+    def __init__(self, f):
+        self.f = f
+        self.evaluations = 0
+        self.elapsed = 0.0
+        self.lapped = 0.0
+
+    def __call__(self, x):
+        t_start = time.time()
+        try:
+            return self.f(x)
+        finally:
+            self.elapsed += time.time()-t_start
+            self.evaluations += 1
+
+    def lap(self):
+        # time spent in f since the previous lap
+        dt, self.lapped = self.elapsed-self.lapped, self.elapsed
+        return dt
+
+    def map(self, xs, pool=None):
+        t_start = time.time()
+        try:
+            if hasattr(self.f, 'map'):
+                return self.f.map(xs, pool)
+            if pool is None:
+                return [self.f(x) for x in xs]
+            return list(pool.map(self.f, xs))
+        finally:
+            self.elapsed += time.time()-t_start
+            self.evaluations += len(xs)
+
+
+def simplex_record(iteration, response, operation, timed, **extra):
+    # one telemetry record for a sorted Nelder-Mead simplex
+    x_best = np.asarray(response[0][0], dtype=float)
+    spread = max(np.max(np.abs(np.asarray(tup[0], dtype=float)-x_best)) for tup in response)
+    record = {'iteration': iteration, 'best': float(response[0][1]), 'x': [float(xi) for xi in x_best],
+              'spread': float(spread), 'operation': operation, 'eval_time': timed.lap(),
+              'total_eval_time': timed.elapsed, 'evaluations': timed.evaluations, 'time': time.time()}
+    record.update(extra)
+    return record
+
+
+class Telemetry(object):
+    def __init__(self, *sinks):
+        """
+        non-blocking callback for optimizer loops, telemetry(record) only enqueues.
+        @param sinks: objects with write(record) and close(), e.g. PrintSink, JsonlSink, NpzSink, LivePlot
+        """
+        self.sinks = sinks
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, record):
+        self.queue.put(record)
+
+    def _consume(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.write(record)
+                except Exception as e:
+                    print('telemetry sink {} failed: {}'.format(sink.__class__.__name__, e))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PrintSink(object):
+    def __init__(self, fmt='iteration {iteration}: best {best:.6g} after {operation}, '
+                 '{evaluations} evaluations, {eval_time:.3g} s in f'):
+        self.fmt = fmt
+
+    def write(self, record):
+        print(self.fmt.format(**record))
+
+    def close(self):
+        pass
+
+
+class JsonlSink(object):
+    # headless: one json object per line, flushed as it arrives
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record)+'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NpzSink(object):
+    # headless: every field collected and written as one array per field on close
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        if not self.records:
+            return
+        np.savez(self.filename, **dict((key, np.array([r[key] for r in self.records])) for key in self.records[0]))
+
+
+def _live_plot(queue, key, ylabel, logy):
+    import matplotlib.pyplot as plt
+    plt.ion()
+    fig = plt.figure()
+    ax = fig.add_subplot(1,1,1)
+    ax.set_xlabel('iterations')
+    ax.set_ylabel(ylabel)
+    values = []
+    while True:
+        try:
+            record = queue.get(timeout=0.1)
+        except Queue.Empty:
+            plt.pause(0.05)
+            continue
+        if record is None:
+            break
+        values.append(record[key])
+        ax.plot(record['iteration'], record[key], 'o', color='k')
+        if logy and len(values) == 2 and min(values) > 0:
+            # a log axis holding a single point cannot be autoscaled
+            ax.set_yscale('log')
+        plt.pause(0.001)
+    plt.ioff()
+    plt.show()
+
+
+class LivePlot(object):
+    # the figure lives in a separate daemon process with its own event loop
+    def __init__(self, key='best', ylabel='function value', logy=True, linger=5.0):
+        """
+        @param linger: seconds the final figure stays open after close(), the process is
+            terminated afterwards so nothing waits on the window at exit
+        """
+        self.linger = linger
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_live_plot, args=(self.queue, key, ylabel, logy))
+        self.process.daemon = True
+        self.process.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join(self.linger)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -1,15 +1,16 @@
 import numpy as np
 from numpy import pi
-from matplotlib import pyplot as plt
-import pylesim.plotting as pyplt
 from scipy import optimize
 from zzwpylesim import envelopes as env
 from zzwpylesim.envelopes import Envelope
-from matplotlib.pyplot import figure
 import zzwpylesim.quantsim as sim
 from scipy.interpolate import interp1d
 import time
 import math
+from lazy_import import lazy_module
+
+plt = lazy_module('matplotlib.pyplot')
+pyplt = lazy_module('pylesim.plotting')
 alpha = 0.7
 nonlin = -0.24
 
@@ -31,11 +32,12 @@ T0 = np.arange(0,20,0.1)
 cosine = cosinex(t0=10, w=20, amp=1.0/20, phase=0.0, df=0)
 q0.uw = cosine-1j*(alpha/(2*np.pi*nonlin))*env.deriv(cosine)
 q0.df = 0.001507537688442211
-rhos0 = system.simulate(psi0, T0, method='fast')
-rhos = rhos0[:,0:2,0:2]
-P0 = rhos[:, 0][:, 0]
-P1 = rhos[:, 1][:, 1]
-P2 = rhos0[:, 2][:, 2]
+
+
+def drag_populations():
+    # populations of the nominal drag pulse, P0, P1 and P2 over T0
+    rhos0 = system.simulate(psi0, T0, method='fast')
+    return rhos0[:, 0][:, 0], rhos0[:, 1][:, 1], rhos0[:, 2][:, 2]
 
 
 def findAlpha(init=0.0, end=2, step=0.01, count=0, error=0.001):
@@ -107,21 +109,23 @@ def findz(init=0.008, end=0.012, num=10, sleep=0.5, count=0, f=0.999, Alpha=1*np
 
     return z, P1z, rhosz
 
-eigval = []
-for ti in range(len(T0)):
-    Hti = q0.H(T0[ti])[1:3,1:3]
-    V, U = np.linalg.eig(Hti)
-    eigval.append((abs(V[1]-V[0])-abs(Hti[1][1]))/2)
-eigval = np.array(eigval) 
-average = sum(eigval/(2*np.pi)*(T0[1]-T0[0]))/T0[-1]
-
-if any(q0.df(T0)) == 0:
-    print 'average =', np.real(average)
-
-# plt.plot(T0,eigval/(2*np.pi))
-# plt.show()
+def average_shift():
+    # time averaged shift of the 1-2 splitting by the drive
+    eigval = []
+    for ti in range(len(T0)):
+        Hti = q0.H(T0[ti])[1:3,1:3]
+        V, U = np.linalg.eig(Hti)
+        eigval.append((abs(V[1]-V[0])-abs(Hti[1][1]))/2)
+    eigval = np.array(eigval) 
+    average = sum(eigval/(2*np.pi)*(T0[1]-T0[0]))/T0[-1]
+    # plt.plot(T0,eigval/(2*np.pi))
+    # plt.show()
+    return average
 
 if __name__ == '__main__':
+    if any(q0.df(T0)) == 0:
+        print 'average =', np.real(average_shift())
+    P0, P1, P2 = drag_populations()
     print 'P1_final =',np.real(P1[-1])
     #pyplt.plotTrajectory(rhos, state=1, labels=True)
     plt.plot(T0,P0,label='P0')